@@ -9,6 +9,8 @@ struct AppState: Codable, Equatable {
     var machineId: String
     var username: String
     var version: String
+    var protocolVersion: Int? = 3 // 2 and up receive "patch" messages instead of the full state, 3 and up "drop" ops
+    var historyOffset: Int? = nil // index of messages[0] in the conversation, older ones are fetched with "history"
 
     var messages: [Message]
     var settings: Settings
@@ -16,7 +18,7 @@ struct AppState: Codable, Equatable {
 }
 
 struct Message: Codable, Equatable, Hashable {
-    let content: String
+    var content: String
     let role: String // user, assistant, debug or system
     var time: Double? = Date().timeIntervalSince1970
 }
@@ -57,6 +59,76 @@ struct PartialWebSocketMessage: Codable {
 struct WebSocketMessage<T: Codable>: Codable {
     let type: String
     let data: T
+    var seq: Int? = nil // server: seq of a full state. client: last seq applied when sending state
+}
+
+struct Empty: Codable {}
+
+// archived messages before the server's window, see WebSocketHandler.send_history in the backend
+struct HistoryRequest: Codable {
+    let before: Int
+    let limit: Int
+}
+
+struct HistoryPage: Codable {
+    let offset: Int
+    let messages: [Message]
+}
+
+
+// Incremental state updates from the server, see WebSocketHandler.state_patch in the backend
+struct StatePatch: Codable {
+    let seq: Int
+    let ops: [PatchOp]
+}
+
+struct PatchOp: Codable {
+    let op: String // truncate, content, replace, append, settings or drop
+    var index: Int?
+    var count: Int?
+    var offset: Int? // in unicode scalars
+    var text: String?
+    var length: Int?
+    var message: Message?
+    var settings: Settings?
+}
+
+struct PatchError: Error {
+    let op: PatchOp
+}
+
+extension AppState {
+    func applying(_ patch: StatePatch) throws -> AppState {
+        var state = self
+        for op in patch.ops {
+            switch (op.op, op.index, op.message) {
+            case ("truncate", _, _):
+                guard let length = op.length, length <= state.messages.count else { throw PatchError(op: op) }
+                state.messages.removeSubrange(length...)
+            case ("content", .some(let i), _):
+                guard i < state.messages.count, let offset = op.offset, let text = op.text,
+                      offset <= state.messages[i].content.unicodeScalars.count else { throw PatchError(op: op) }
+                var scalars = String.UnicodeScalarView(state.messages[i].content.unicodeScalars.prefix(offset))
+                scalars.append(contentsOf: text.unicodeScalars)
+                state.messages[i].content = String(scalars)
+            case ("replace", .some(let i), .some(let message)):
+                guard i < state.messages.count else { throw PatchError(op: op) }
+                state.messages[i] = message
+            case ("append", _, .some(let message)):
+                state.messages.append(message)
+            case ("settings", _, _):
+                guard let settings = op.settings else { throw PatchError(op: op) }
+                state.settings = settings
+            case ("drop", _, _):
+                guard let count = op.count, count <= state.messages.count else { throw PatchError(op: op) }
+                state.messages.removeFirst(count)
+                state.historyOffset = (state.historyOffset ?? 0) + count
+            default:
+                throw PatchError(op: op)
+            }
+        }
+        return state
+    }
 }
 
 
@@ -64,9 +136,15 @@ struct WebSocketMessage<T: Codable>: Codable {
 
 struct ChatView: View {
     @Binding var appState: AppState
+    @Binding var olderMessages: [Message] // fetched from the server, right before appState.messages
     @State var newMessage: String = "" // TODO: Move into AppState for telemetry
     var sync: StateSyncManager
 
+    // number of messages before the oldest one we have
+    var olderAvailable: Int {
+        return (appState.historyOffset ?? 0) - olderMessages.count
+    }
+
     func send() {
         guard !newMessage.isEmpty else { return }
         appState.messages.append(Message(content: newMessage, role: "user"))
@@ -78,7 +156,10 @@ struct ChatView: View {
         VStack {
             ScrollViewReader { proxy in
                 List {
-                    ForEach(appState.messages.filter { showRole($0.role) }, id: \.self) { message in
+                    if olderAvailable > 0 {
+                        Button("Load older messages") { sync.requestHistory(before: olderAvailable) }
+                    }
+                    ForEach((olderMessages + appState.messages).filter { showRole($0.role) }, id: \.self) { message in
                         MessageView(message: message)
                     }
                     Color.clear.frame(height: 0).id("PaddingBottom")
@@ -151,9 +232,16 @@ struct SettingsView: View {
 
 // WebSocket Implementation that automatically buffers messages and reconnects 
 class ConnectionManager {
+    // close code the server uses when a newer connection for this machine took over
+    static let replacedCloseCode: UInt16 = 4001
+
+    // seconds between heartbeats, sent while connected so the server knows we're still here when nothing changes
+    static let heartbeatInterval: Double = 60
+
     private var bufferedMessages: [String] = []
     private var isConnected: Bool = false
     private var reconnectionTimer: Timer?
+    private var heartbeatTimer: Timer?
     private var ws: WebSocket!
     // get WS_URL from enviornment, default to localhost:8000/ws
 
@@ -189,7 +277,8 @@ class ConnectionManager {
     }
 
     private func connect() {
-        self.ws = WebSocket(request: URLRequest(url: url))
+        // offer permessage-deflate: states and window names compress well, servers that don't support it send plain frames
+        self.ws = WebSocket(request: URLRequest(url: url), compressionHandler: WSCompression())
         self.ws.onEvent = { event in
             self.didReceive(event: event, client: self.ws)
         }
@@ -206,10 +295,24 @@ class ConnectionManager {
 
     private func disconnected() {
         self.isConnected = false
+        self.stopHeartbeat()
         self.ws.disconnect()
         self.attemptReconnect()
     }
 
+    // not buffered: a heartbeat is only worth anything when it's sent
+    private func startHeartbeat() {
+        stopHeartbeat()
+        heartbeatTimer = Timer.scheduledTimer(withTimeInterval: ConnectionManager.heartbeatInterval, repeats: true) { _ in
+            if self.isConnected { self.send(WebSocketMessage(type: "heartbeat", data: Empty())) }
+        }
+    }
+
+    private func stopHeartbeat() {
+        heartbeatTimer?.invalidate()
+        heartbeatTimer = nil
+    }
+
     private func connected() {
         print("Connected!")
         isConnected = true
@@ -223,6 +326,7 @@ class ConnectionManager {
             self.write(string: message)
         }
         bufferedMessages.removeAll()
+        startHeartbeat()
 
         // Call onConnectCallback
         onConnectCallback()
@@ -232,7 +336,14 @@ class ConnectionManager {
         switch event {
         case .connected:
             self.connected()
-        case .disconnected(_, _):
+        case .disconnected(let reason, let code):
+            if code == ConnectionManager.replacedCloseCode {
+                // another instance of the app connected for this machine, it's the one talking to the server now
+                print("Replaced by another connection, not reconnecting: \(reason)")
+                self.isConnected = false
+                self.stopHeartbeat()
+                return
+            }
             self.disconnected()
         case .peerClosed:
             self.disconnected()
@@ -274,6 +385,14 @@ class StateSyncManager {
     private var lastUpdate: Int // last update in epoch time
     private let updateFreq: Int // send updated state every n seconds (if state changed)
     private var timer: Timer?
+    private var pending: AppState? // waiting for timer
+
+    // what the server has, when only the activity changed it's sent on its own
+    private var lastSynced: AppState?
+    private var lastActivity: Activity?
+
+    // seq of the last state/patch applied from the server, nil until we get a full state
+    public var seq: Int?
 
     init(conn: ConnectionManager, updateFreq: Int = 10) {
         self.conn = conn
@@ -286,6 +405,16 @@ class StateSyncManager {
     }
 
     func onStateChange(_ appState: AppState) {
+        // only the visible windows changed: a small "activity" message instead of the whole state
+        if var last = pending ?? lastSynced {
+            last.activity = appState.activity
+            if last == appState {
+                pending?.activity = appState.activity
+                sendActivity(appState.activity)
+                return
+            }
+        }
+
         let timeSince = timeSinceLastUpdate()
         if timeSince >= updateFreq {
             // print("Last update was \(timeSince) seconds ago. Syncing state...")
@@ -303,17 +432,51 @@ class StateSyncManager {
     func trySyncAfter(_ appState: AppState, timeToWait: Int) {
         // cancel any existing timer; we want to sync the most recent state change
         timer?.invalidate()
+        pending = appState
         timer = Timer.scheduledTimer(withTimeInterval: Double(timeToWait), repeats: false) { _ in
             // we didn't handle the previous state change, so we push it again
-            // to handle it now.
-            self.onStateChange(appState)
+            // to handle it now. (pending has any activity changes since)
+            guard let appState = self.pending else { return }
+            self.pending = nil
             self.timer = nil
+            self.onStateChange(appState)
         }
     }
 
     func syncState(_ appState: AppState) {
-        conn.send(WebSocketMessage(type: "state", data: appState))
+        // this is the newest state, anything waiting to be synced is older
+        timer?.invalidate()
+        timer = nil
+        pending = nil
+
+        conn.send(WebSocketMessage(type: "state", data: appState, seq: seq))
         lastUpdate = Int(Date().timeIntervalSince1970)
+        lastSynced = appState
+        lastActivity = appState.activity
+    }
+
+    func sendActivity(_ activity: Activity) {
+        guard activity != lastActivity else { return }
+        conn.send(WebSocketMessage(type: "activity", data: activity))
+        lastActivity = activity
+        lastSynced?.activity = activity
+    }
+
+    // apply a patch if it directly follows what we have, otherwise ask for the full state
+    func applyPatch(_ patch: StatePatch, to appState: AppState) -> AppState? {
+        guard let seq = seq, patch.seq == seq + 1, let newState = try? appState.applying(patch) else {
+            print("Can't apply patch \(patch.seq) on top of \(String(describing: seq)), requesting resync")
+            self.seq = nil
+            conn.send(WebSocketMessage(type: "resync", data: Empty()))
+            return nil
+        }
+        self.seq = patch.seq
+        return newState
+    }
+
+    // archived messages come back in a "history" message
+    func requestHistory(before: Int, limit: Int = 50) {
+        conn.send(WebSocketMessage(type: "history", data: HistoryRequest(before: before, limit: limit)))
     }
 }
 
@@ -335,6 +498,7 @@ struct MyApp: App {
         ), // TODO: make checkInInterval configurable
         activity: Activity(visibleWindows: getVisibleWindows())
     )
+    @State var olderMessages: [Message] = []
     var conn: ConnectionManager
     var sync: StateSyncManager
     @State var timer: Timer? // TODO: check no weird update properties
@@ -353,14 +517,14 @@ struct MyApp: App {
         WindowGroup {
             NavigationView {
                 List {
-                    NavigationLink(destination: ChatView(appState: $appState, sync: sync)) {
+                    NavigationLink(destination: ChatView(appState: $appState, olderMessages: $olderMessages, sync: sync)) {
                         Text("Chat")
                     }
                     NavigationLink(destination: SettingsView(settings: $appState.settings)) {
                         Text("Settings")
                     }
                 }
-                ChatView(appState: $appState, sync: sync)
+                ChatView(appState: $appState, olderMessages: $olderMessages, sync: sync)
             }
             .onAppear {
                 setupHotKeys()
@@ -372,6 +536,19 @@ struct MyApp: App {
 
                         // TODO: Check creation time and only update if newer
                         self.appState = msg.data
+                        sync.seq = msg.seq
+                    case "patch":
+                        let msg = try JSONDecoder().decode(WebSocketMessage<StatePatch>.self, from: data)
+                        if let newState = sync.applyPatch(msg.data, to: self.appState) {
+                            self.appState = newState
+                        }
+                    case "history":
+                        let msg = try JSONDecoder().decode(WebSocketMessage<HistoryPage>.self, from: data)
+                        // only if it still goes right before what we have
+                        let before = (self.appState.historyOffset ?? 0) - self.olderMessages.count
+                        if msg.data.offset + msg.data.messages.count == before {
+                            self.olderMessages = msg.data.messages + self.olderMessages
+                        }
                     case "notification":
                         let msg = try JSONDecoder().decode(WebSocketMessage<Notification>.self, from: data)
                         print("Received notification: \(msg.data)")
@@ -390,7 +567,8 @@ struct MyApp: App {
                 conn.onConnectCallback = { sync.syncState(appState) }
 
 
-                // update activity information frequently. note: this triggers onChange.
+                // update activity information frequently. note: this triggers onChange when the windows changed,
+                // which sends them. otherwise the connection's heartbeat says they're still the same.
                 timer = Timer.scheduledTimer(withTimeInterval: 10, repeats: true) { _ in
                     updateActivity()
                 }
@@ -399,6 +577,10 @@ struct MyApp: App {
                 // NOTE: probably not needed if the app is closing
                 timer?.invalidate()
             }
+            .onChange(of: appState.historyOffset) { _ in
+                // the window moved (or the conversation was cleared), fetched pages no longer line up with it
+                olderMessages = []
+            }
             .onChange(of: appState) { newState in
                 appState.settings.timezone = TimeZone.current.identifier
                 updateActivity()
@@ -419,6 +601,12 @@ struct MyApp: App {
     }
 
     private func updateActivity() {
-        appState.activity = Activity(visibleWindows: getVisibleWindows())
+        // sorted, so windows moving in front of each other isn't a change
+        let windows = getVisibleWindows().sorted {
+            ($0.kCGWindowOwnerName, $0.kCGWindowName) < ($1.kCGWindowOwnerName, $1.kCGWindowName)
+        }
+        if windows != appState.activity.visibleWindows {
+            appState.activity = Activity(visibleWindows: windows)
+        }
     }
 }
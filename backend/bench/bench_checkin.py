@@ -0,0 +1,160 @@
+"""
+Check-in latency regression benchmark.
+
+Seeds a synthetic database with more and more other users' history, and times the queries a
+check-in / reconnect makes for one user (get_activity_times, load_app_state). Fails if latency
+grows with the table size, or if any of those queries does a full table scan.
+
+    cd backend && python bench/bench_checkin.py [--sizes 10000 100000 1000000] [--max-ratio 3]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import pytz
+
+# main expects to run from backend/ with these set
+BACKEND = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+os.chdir(BACKEND)
+sys.path.insert(0, BACKEND)
+os.environ.setdefault('OPENAI_API_KEY', 'bench')
+os.environ.setdefault('HOST', 'bench')
+
+import main  # noqa: E402
+
+
+APPS = ['Google Chrome', 'Code', 'Slack', 'Terminal', 'Notion', 'Spotify', 'Zoom', 'Finder']
+TITLES = 500
+USER_ID = 1
+
+
+def seed_user(conn, user_id: int, samples: int, end_ts: int):
+    "A day or so of realistic activity for the benchmarked user, through the real write path"
+    c = conn.cursor()
+    with conn:
+        c.execute("INSERT INTO users (id, machine_id, username) VALUES (?, ?, ?)", (user_id, f'machine-{user_id}', 'bench'))
+        for i in range(samples):
+            windows = [
+                {'kCGWindowOwnerName': app, 'kCGWindowName': f'{app} window {random.randrange(20)}'}
+                for app in random.sample(APPS, 3)
+            ]
+            main.record_activity(c, user_id, end_ts - (samples - i) * 60, windows)
+        main.store_state(
+            conn, user_id,
+            [(i, f'{{"role": "user", "content": "message {i}"}}') for i in range(200)],
+            '{"machineId": "machine-1", "username": "bench", "settings": {"prompts": [], "checkInInterval": 600, '
+            '"timezone": "UTC"}, "activity": {"visibleWindows": []}}',
+            end_ts, [], None,
+        )
+
+
+def grow(conn, first_user: int, rows: int, end_ts: int):
+    "Bulk insert other users' history, rows samples spread over 50 users and 30 days"
+    users = range(first_user, first_user + 50)
+    with conn:
+        conn.executemany("INSERT OR IGNORE INTO users (id, machine_id) VALUES (?, ?)", [(u, f'machine-{u}') for u in users])
+        conn.executemany("INSERT OR IGNORE INTO window_titles (id, title) VALUES (?, ?)", [(t, f'title {t}') for t in range(1000, 1000 + TITLES)])
+        samples, windows, rollups, events = [], [], [], []
+        for i in range(rows):
+            user = users[i % len(users)]
+            ts = end_ts - random.randrange(30 * 24 * 3600)
+            app, title = random.randrange(1, len(APPS) + 1), 1000 + random.randrange(TITLES)
+            samples.append((user, ts))
+            windows.append((user, ts, app, title))
+            rollups.append((user, 60, ts - ts % 60, app, title, 60))
+            rollups.append((user, 3600, ts - ts % 3600, app, title, 60))
+            events.append((user, i, f'{{"role": "user", "content": "filler {i}"}}'))
+        conn.executemany("INSERT OR IGNORE INTO activity_samples (user_id, ts) VALUES (?, ?)", samples)
+        conn.executemany("INSERT INTO activity_windows (user_id, ts, app_id, title_id) VALUES (?, ?, ?, ?)", windows)
+        conn.executemany("""
+            INSERT INTO activity_rollups (user_id, resolution, bucket, app_id, title_id, seconds) VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT DO UPDATE SET seconds = seconds + excluded.seconds
+        """, rollups)
+        conn.executemany("INSERT INTO message_events (user_id, idx, message_json) VALUES (?, ?, ?)", events)
+        conn.executemany("INSERT INTO app_states (user_id, state_json) VALUES (?, ?)", [(u, '{}') for u, _ in samples[::100]])
+    conn.execute("ANALYZE")
+
+
+def time_check_in(conn, repeat: int) -> float:
+    "Median seconds for the queries behind one check-in plus one reconnect"
+    tz = pytz.timezone('UTC')
+    timings = []
+    for _ in range(repeat):
+        end = datetime.now(tz)
+        start = time.perf_counter()
+        main.get_activity_times(conn, USER_ID, end - timedelta(minutes=10), end)
+        main.get_activity_times(conn, USER_ID, end - timedelta(days=1), end)
+        main.load_app_state(conn, USER_ID)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def full_scans(conn) -> list:
+    "Hot queries whose plan scans a whole table instead of searching an index"
+    now = int(time.time())
+    queries = [
+        ("SELECT MAX(ts) FROM activity_samples WHERE user_id = ?", (USER_ID,)),
+        ("SELECT app_id, title_id FROM activity_windows WHERE user_id = ? AND ts = ?", (USER_ID, now)),
+        ("""SELECT app_id, title_id, SUM(seconds) FROM activity_rollups
+            WHERE user_id = ? AND resolution = ? AND bucket >= ? AND bucket < ? GROUP BY app_id, title_id""", (USER_ID, 60, now - 600, now)),
+        ("SELECT state_json FROM user_states WHERE user_id = ?", (USER_ID,)),
+        ("SELECT event_id, messages_json FROM state_snapshots WHERE user_id = ? ORDER BY id DESC LIMIT 1", (USER_ID,)),
+        ("SELECT idx, message_json FROM message_events WHERE user_id = ? AND id > ? ORDER BY id ASC", (USER_ID, 0)),
+        ("SELECT state_json FROM app_states WHERE user_id = ? ORDER BY created_at DESC LIMIT 1", (USER_ID,)),
+        ("SELECT id FROM users WHERE machine_id = ?", ('machine-1',)),
+    ]
+    scans = []
+    for query, params in queries:
+        plan = ' '.join(row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", params))
+        if 'SCAN' in plan and 'USING' not in plan:
+            scans.append(f'{" ".join(query.split())}\n    -> {plan}')
+    return scans
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000],
+                        help='total rows of other users\' activity samples to benchmark at')
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--max-ratio', type=float, default=3.0,
+                        help='fail if the largest size is this many times slower than the smallest')
+    args = parser.parse_args()
+
+    random.seed(0)
+    path = os.path.join(tempfile.mkdtemp(), 'bench.sqlite3')
+    conn = sqlite3.connect(path)
+    main.setup_db(conn)
+    end_ts = int(time.time())
+    seed_user(conn, USER_ID, 24 * 60, end_ts)
+
+    results, rows = [], 0
+    for size in sorted(args.sizes):
+        grow(conn, 1000 + len(results) * 50, size - rows, end_ts)
+        rows = size
+        results.append((size, time_check_in(conn, args.repeat)))
+        print(f'{size:>10} rows  {results[-1][1] * 1000:8.2f}ms per check-in', flush=True)
+
+    failed = False
+    scans = full_scans(conn)
+    if scans:
+        failed = True
+        print('\nFAIL: full table scans in hot queries:\n' + '\n'.join(scans))
+
+    ratio = results[-1][1] / results[0][1]
+    print(f'\n{results[-1][0]} rows is {ratio:.2f}x the latency of {results[0][0]} rows (max {args.max_ratio}x)')
+    if ratio > args.max_ratio:
+        failed = True
+        print('FAIL: check-in latency grows with table size')
+
+    conn.close()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    run()
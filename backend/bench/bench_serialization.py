@@ -0,0 +1,95 @@
+"""
+State serialization microbenchmark.
+
+Times what a streamed reply costs per chunk for histories of different lengths: the full state
+payload (clients without the patch protocol get one per chunk) and the snapshot written with the
+state, serialized the old way (model_dump every message, then json.dumps) and from the messages'
+cached JSON (AppState.dump_json / Message.dump_json).
+
+    cd backend && python bench/bench_serialization.py [--sizes 10 1000 10000]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+# main expects to run from backend/ with these set
+BACKEND = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+os.chdir(BACKEND)
+sys.path.insert(0, BACKEND)
+os.environ.setdefault('OPENAI_API_KEY', 'bench')
+os.environ.setdefault('HOST', 'bench')
+
+import main  # noqa: E402
+
+
+def make_state(n: int) -> main.AppState:
+    messages = [{'role': 'system', 'content': main.SYSTEM_PROMPT, 'time': 0.0}]
+    for i in range(1, n):
+        if i % 2:
+            messages.append({'role': 'user', 'content': f'[ACTIVITY REPORT]: - 5min on Code\n  - 3min on main.py ({i})', 'time': float(i)})
+        else:
+            messages.append({'role': 'assistant', 'content': f'Great work! Keep going with message {i}', 'time': float(i)})
+    return main.AppState.model_validate({
+        'machineId': 'bench', 'username': 'bench', 'protocolVersion': 1, 'messages': messages,
+        'settings': {'prompts': [], 'checkInInterval': 600, 'timezone': 'UTC'},
+        'activity': {'visibleWindows': [{'kCGWindowOwnerName': 'Code', 'kCGWindowName': 'main.py'}]},
+    })
+
+
+def old_state(state: main.AppState) -> str:
+    return json.dumps({"type": "state", "seq": 1, "data": state.model_dump(by_alias=True)})
+
+
+def new_state(state: main.AppState) -> str:
+    return f'{{"type":"state","seq":1,"data":{state.dump_json()}}}'
+
+
+def old_snapshot(state: main.AppState) -> str:
+    return json.dumps([m.model_dump() for m in state.messages])
+
+
+def new_snapshot(state: main.AppState) -> str:
+    return main.json_list(m.dump_json() for m in state.messages)
+
+
+def time_chunks(state: main.AppState, serialize, chunks: int) -> float:
+    "Median seconds to serialize after each streamed chunk of a new reply"
+    streaming = main.Message(role='assistant', content='')
+    state.messages.append(streaming)
+    serialize(state)  # warm up, finished messages are cached from here on
+    timings = []
+    for i in range(chunks):
+        streaming.content += f' word{i}'
+        start = time.perf_counter()
+        serialize(state)
+        timings.append(time.perf_counter() - start)
+    state.messages.pop()
+    return statistics.median(timings)
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1_000, 10_000], help='messages in the history')
+    parser.add_argument('--chunks', type=int, default=50, help='streamed chunks to time per size')
+    args = parser.parse_args()
+
+    # same payloads, except nested messages used to have "function_call": null
+    state = make_state(10)
+    old = json.loads(old_state(state))
+    old['data']['messages'] = [{k: v for k, v in m.items() if v is not None} for m in old['data']['messages']]
+    assert old == json.loads(new_state(state)), 'state payloads differ'
+    assert json.loads(old_snapshot(state)) == json.loads(new_snapshot(state)), 'snapshots differ'
+
+    print(f'{"messages":>10} {"payload":>10} {"old":>10} {"new":>10} {"speedup":>8}')
+    for size in args.sizes:
+        for name, old, new in [('state', old_state, new_state), ('snapshot', old_snapshot, new_snapshot)]:
+            t_old = time_chunks(make_state(size), old, args.chunks)
+            t_new = time_chunks(make_state(size), new, args.chunks)
+            print(f'{size:>10} {name:>10} {t_old * 1000:>8.3f}ms {t_new * 1000:>8.3f}ms {t_old / t_new:>7.1f}x', flush=True)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,128 @@
+"""
+Streamed completion parsing benchmark.
+
+Replays the recorded streams in bench/fixtures through the old stream_completion parsing (lines,
+recursive dict updates with string +=, FunctionCall validated every chunk) and the incremental one
+(SSEParser + DeltaAssembler, one update per read), reading the message after every update like
+respond_to_msg does. --scale repeats the deltas to show how each grows with the reply's length.
+
+    cd backend && python bench/bench_sse.py [--scale 1 10 50] [--read-size 512]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+# main expects to run from backend/ with these set
+BACKEND = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+os.chdir(BACKEND)
+sys.path.insert(0, BACKEND)
+os.environ.setdefault('OPENAI_API_KEY', 'bench')
+os.environ.setdefault('HOST', 'bench')
+
+import main  # noqa: E402
+from httpx._decoders import LineDecoder, TextDecoder  # noqa: E402
+from openai_client import DeltaAssembler, SSEParser  # noqa: E402
+
+
+FIXTURES = os.path.join(BACKEND, 'bench', 'fixtures')
+STREAMS = ['chat_completion_stream.txt', 'function_call_stream.txt']
+
+
+def load(name: str, scale: int) -> bytes:
+    "The fixture with its middle (delta) events repeated scale times"
+    events = [e + '\n\n' for e in open(os.path.join(FIXTURES, name)).read().split('\n\n') if e]
+    first, deltas, last = events[:1], events[1:-2], events[-2:]
+    return ''.join(first + deltas * scale + last).encode()
+
+
+def old_parse(raw: bytes, read_size: int) -> main.Message:
+    "stream_completion before the incremental parser, with lines decoded the way resp.aiter_lines does"
+    def _update(delta, data):
+        for k, v in delta.items():
+            if isinstance(data.get(k), str):
+                data[k] += v
+            elif isinstance(data.get(k), dict):
+                data[k] = _update(v, data[k])
+            else:
+                data[k] = v
+        return data
+
+    def aiter_lines():
+        text, lines = TextDecoder(), LineDecoder()
+        for i in range(0, len(raw), read_size):
+            yield from lines.decode(text.decode(raw[i:i + read_size]))
+
+    message = main.Message(role='')
+    data = {}
+    for chunk in aiter_lines():
+        if not chunk.startswith("data: "):
+            continue
+        data_str = chunk.split("data: ")[1].strip()
+        resp_json = json.loads(data_str)
+        choice = resp_json['choices'][0]
+        delta = choice.get('delta')
+        if choice['finish_reason'] or delta is None:
+            break
+
+        data = _update(delta, data)
+
+        message.role, message.content = data['role'], data.get('content')
+        if data.get('function_call'):
+            message.function_call = main.FunctionCall.model_validate(data['function_call'])
+        message.dump_json()  # the consumer sending it
+    return message
+
+
+def new_parse(raw: bytes, read_size: int) -> main.Message:
+    "stream_completion's loop, with raw arriving read_size bytes at a time"
+    message = main.Message(role='')
+    parser, assembler = SSEParser(), DeltaAssembler()
+    for i in range(0, len(raw), read_size):
+        for data in parser.feed(raw[i:i + read_size]):
+            assembler.add(data)
+        choice = assembler.choices.get(0)
+        if choice and choice.changed:
+            choice.changed = False
+            message.role, message.content = choice.role, choice.content
+            if choice.has_function_call:
+                message.function_call = main.FunctionCall.model_construct(**choice.function_call)
+            message.dump_json()  # the consumer sending it
+        if assembler.finished:
+            break
+    return message
+
+
+def timed(fn, *args, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', type=int, nargs='+', default=[1, 10, 50], help='times to repeat the deltas')
+    parser.add_argument('--read-size', type=int, default=512, help='bytes per network read')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f'{"stream":>28} {"scale":>6} {"events":>7} {"old":>10} {"new":>10} {"speedup":>8}')
+    for name in STREAMS:
+        for scale in args.scale:
+            raw = load(name, scale)
+            old, new = old_parse(raw, args.read_size), new_parse(raw, args.read_size)
+            assert (old.role, old.content or None, old.function_call) == (new.role, new.content, new.function_call), \
+                f'{name} parsed differently'
+            t_old = timed(old_parse, raw, args.read_size, repeat=args.repeat)
+            t_new = timed(new_parse, raw, args.read_size, repeat=args.repeat)
+            events = raw.count(b'data: ')
+            print(f'{name:>28} {scale:>6} {events:>7} {t_old * 1000:>8.2f}ms {t_new * 1000:>8.2f}ms {t_old / t_new:>7.1f}x', flush=True)
+
+
+if __name__ == '__main__':
+    run()
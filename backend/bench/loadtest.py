@@ -0,0 +1,501 @@
+"""
+Load test: how many clients one server process can serve.
+
+Starts a stub of the OpenAI chat completions API (streaming and non-streaming, with configurable
+latency), runs main.py under uvicorn against it with a fresh database, then connects N simulated
+clients speaking the app's websocket protocol (state / patch / notification / utterance, as in
+Sources/App/AppMain.swift). Each client checks its visible windows every --sync-every seconds,
+sending them when they changed (--window-changes of the time) and a heartbeat every
+--heartbeat-every seconds, and sends a chat message every --chat-every seconds on average.
+--full-state clients resend the whole state on every check instead, like older app versions.
+--reconnects N drops and reopens each connection N times, with --ramp 0 every client at once like
+after a network blip.
+
+Clients offer permessage-deflate like the app does, --compression none measures ones that don't.
+Throughput counts message characters and the bytes on the wire (frames, compressed or not).
+
+Reports connect and chat latencies (p50/p99), throughput, database growth and server memory per
+connection. --out saves the results as JSON, --compare prints the change against a saved run.
+
+    cd backend && python bench/loadtest.py --clients 200 --duration 60 [--out run.json] [--compare base.json]
+
+Needs the `websockets` package for the simulated clients.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+import uvicorn
+import websockets
+from websockets.asyncio.client import ClientConnection
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+BACKEND = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+APPS = {
+    'Code': ['main.py — ana', 'storage.py — ana', 'README.md — ana'],
+    'Google Chrome': ['Pull requests · ana', 'Stack Overflow', 'YouTube - lofi hip hop radio', 'Twitter / Home'],
+    'Slack': ['#general', '#backend', 'Direct message'],
+    'Terminal': ['zsh', 'python bench/loadtest.py'],
+}
+CHATS = ["I want to finish the backend today", "yes that's right", "taking a short break", "back to work"]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class CountingTransport:
+    "A transport that counts the bytes written to it"
+    def __init__(self, transport, stats: dict):
+        self.transport = transport
+        self.stats = stats
+
+    def write(self, data):
+        self.stats['wire_bytes_out'] += len(data)
+        self.transport.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+
+def counting_connection(stats: dict):
+    "A websockets connection class that counts the bytes it sends and receives, after compression"
+    class CountingConnection(ClientConnection):
+        def connection_made(self, transport):
+            super().connection_made(CountingTransport(transport, stats))
+
+        def data_received(self, data: bytes):
+            stats['wire_bytes_in'] += len(data)
+            super().data_received(data)
+    return CountingConnection
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(p * len(values)), len(values) - 1)] if values else None
+
+
+# Stub of the OpenAI API
+
+def stub_app(ttft: float, token_delay: float, off_task: float) -> FastAPI:
+    "POST /v1/chat/completions answering check-ins and chats in the shape GPT-4 does"
+    stub = FastAPI()
+
+    def reply(messages) -> str:
+        last = messages[-1].get('content') or '' if messages else ''
+        if last.startswith('[ACTIVITY REPORT]'):
+            if random.random() < off_task:
+                return '"""The user is on YouTube, not coding. Therefor the user should be interrupted.""" Hey, what are you watching?'
+            return '"""The user is coding, as they said they would. Therefor the user should not be interrupted.""" Great work!'
+        return "Got it! So coding in Code and Terminal is fine, while YouTube and Twitter aren't. Is that right?"
+
+    def chunk(delta, finish=None):
+        return 'data: ' + json.dumps({
+            'id': 'chatcmpl-stub', 'object': 'chat.completion.chunk', 'model': 'gpt-4',
+            'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish}],
+        }) + '\n\n'
+
+    @stub.post('/v1/chat/completions')
+    async def completions(request: Request):
+        body = await request.json()
+        content = reply(body.get('messages', []))
+        await asyncio.sleep(ttft)
+        if not body.get('stream'):
+            await asyncio.sleep(token_delay * len(content) / 4)
+            return JSONResponse({
+                'id': 'chatcmpl-stub', 'object': 'chat.completion', 'model': 'gpt-4',
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+            })
+
+        async def stream():
+            yield chunk({'role': 'assistant', 'content': ''})
+            for token in re.findall(r'\s*\S{1,4}', content):
+                await asyncio.sleep(token_delay)
+                yield chunk({'content': token})
+            yield chunk({}, 'stop')
+            yield 'data: [DONE]\n\n'
+        return StreamingResponse(stream(), media_type='text/event-stream')
+
+    return stub
+
+
+def start_stub(port: int, **kwargs) -> uvicorn.Server:
+    "Serve the stub from a thread with its own event loop, so the clients' load doesn't slow it down"
+    server = uvicorn.Server(uvicorn.Config(stub_app(**kwargs), port=port, log_level='warning'))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+# Simulated clients
+
+class Client():
+    "The app's side of the protocol: keeps the state in sync, applies patches, resyncs when they don't apply"
+
+    def __init__(self, url: str, machine_id: str, stats: dict):
+        self.url = url
+        self.stats = stats
+        self.seq = None
+        self.state = {
+            'machineId': machine_id, 'username': 'loadtest', 'version': 'loadtest', 'protocolVersion': 3,
+            'messages': [],
+            'settings': {'prompts': [], 'checkInInterval': 600, 'timezone': 'UTC', 'debug': False, 'popup': True, 'tts': False},
+            'activity': {'visibleWindows': []},
+        }
+        self.got_state = asyncio.Event()
+        self.chat_sent_at = None
+        self.chat_first_at = None
+        self.assistant_seen = 0
+
+
+    def windows(self):
+        apps = random.sample(list(APPS), 2)
+        return [{'kCGWindowOwnerName': app, 'kCGWindowName': random.choice(APPS[app])} for app in apps]
+
+
+    async def send(self, ws, msg: dict):
+        text = json.dumps(msg)
+        self.stats['bytes_out'] += len(text)
+        self.stats['messages_out'] += 1
+        await ws.send(text)
+
+
+    async def sync(self, ws):
+        await self.send(ws, {'type': 'state', 'data': self.state, 'seq': self.seq})
+
+
+    async def check_windows(self, ws, args):
+        "What the app's activity timer does"
+        changed = random.random() < args.window_changes
+        if changed:
+            self.state['activity']['visibleWindows'] = self.windows()
+        if args.full_state:
+            await self.sync(ws)
+        elif changed:
+            await self.send(ws, {'type': 'activity', 'data': self.state['activity']})
+
+
+    def apply_patch(self, patch: dict):
+        messages = self.state['messages']
+        for op in patch['ops']:
+            if op['op'] == 'truncate':
+                del messages[op['length']:]
+            elif op['op'] == 'content':
+                m = messages[op['index']]
+                m['content'] = (m.get('content') or '')[:op['offset']] + op['text']
+            elif op['op'] == 'replace':
+                messages[op['index']] = op['message']
+            elif op['op'] == 'append':
+                messages.append(op['message'])
+            elif op['op'] == 'settings':
+                self.state['settings'] = op['settings']
+            elif op['op'] == 'drop':
+                self.assistant_seen -= sum(1 for m in messages[:op['count']] if m['role'] == 'assistant' and m.get('content'))
+                del messages[:op['count']]
+                self.state['historyOffset'] = self.state.get('historyOffset', 0) + op['count']
+            else:
+                raise ValueError(f'unknown op {op}')
+
+
+    def on_messages_changed(self):
+        "Chat latency: time to the reply's first content"
+        assistant = sum(1 for m in self.state['messages'] if m['role'] == 'assistant' and m.get('content'))
+        if self.chat_sent_at and not self.chat_first_at and assistant > self.assistant_seen:
+            self.chat_first_at = time.perf_counter()
+            self.stats['chat_first_token'].append(self.chat_first_at - self.chat_sent_at)
+        self.assistant_seen = assistant
+
+
+    async def receive(self, ws):
+        async for text in ws:
+            self.stats['bytes_in'] += len(text)
+            self.stats['messages_in'] += 1
+            msg = json.loads(text)
+            if msg['type'] == 'state':
+                self.state = msg['data']
+                self.seq = msg.get('seq')
+                self.got_state.set()
+            elif msg['type'] == 'patch':
+                if self.seq is not None and msg['data']['seq'] != self.seq + 1:
+                    await self.send(ws, {'type': 'resync'})
+                    continue
+                try:
+                    self.apply_patch(msg['data'])
+                except (IndexError, KeyError, ValueError):
+                    self.stats['resyncs'] += 1
+                    await self.send(ws, {'type': 'resync'})
+                    continue
+                self.seq = msg['data']['seq']
+            elif msg['type'] == 'notification':
+                self.stats['notifications'] += 1
+                if self.chat_sent_at and self.chat_first_at:
+                    self.stats['chat_complete'].append(time.perf_counter() - self.chat_sent_at)
+                    self.stats['chats_completed'] += 1
+                    self.chat_sent_at = self.chat_first_at = None
+            elif msg['type'] == 'utterance':
+                self.stats['utterances'] += 1
+            self.on_messages_changed()
+
+
+    async def run(self, args):
+        "Stay connected for --duration, split into --reconnects + 1 connections"
+        start = time.perf_counter()
+        for i in range(args.reconnects + 1):
+            end = start + args.duration * (i + 1) / (args.reconnects + 1)
+            if not await self.connection(args, end, 'connect' if i == 0 else 'reconnect'):
+                break
+
+
+    async def connection(self, args, end: float, kind: str) -> bool:
+        "One connection until end, False if it failed"
+        start = time.perf_counter()
+        self.got_state.clear()
+        # a reply that was on its way when the last connection closed isn't coming
+        self.chat_sent_at = self.chat_first_at = None
+        try:
+            async with websockets.connect(
+                self.url, max_size=None, compression=None if args.compression == 'none' else 'deflate',
+                create_connection=counting_connection(self.stats),
+            ) as ws:
+                receiver = asyncio.create_task(self.receive(ws))
+                self.state['activity']['visibleWindows'] = self.windows()
+                await self.sync(ws)
+                await asyncio.wait_for(self.got_state.wait(), timeout=30)
+                self.stats[kind].append(time.perf_counter() - start)
+
+                next_sync = time.perf_counter() + random.uniform(0, args.sync_every)
+                next_heartbeat = time.perf_counter() + args.heartbeat_every
+                next_chat = time.perf_counter() + random.expovariate(1 / args.chat_every)
+                while time.perf_counter() < end and not receiver.done():
+                    now = time.perf_counter()
+                    if now >= next_chat and self.chat_sent_at is None:
+                        self.state['messages'].append({'role': 'user', 'content': random.choice(CHATS), 'time': time.time()})
+                        self.chat_sent_at = now
+                        self.stats['chats_sent'] += 1
+                        await self.sync(ws)
+                        next_chat = now + random.expovariate(1 / args.chat_every)
+                    elif now >= next_sync:
+                        await self.check_windows(ws, args)
+                        next_sync = now + args.sync_every
+                    elif now >= next_heartbeat:
+                        if not args.full_state:
+                            await self.send(ws, {'type': 'heartbeat'})
+                        next_heartbeat = now + args.heartbeat_every
+                    await asyncio.sleep(max(0.0, min(next_sync, next_heartbeat, next_chat, end) - time.perf_counter()))
+                receiver.cancel()
+            return True
+        except Exception as e:
+            self.stats['errors'] += 1
+            self.stats['error_types'][type(e).__name__] += 1
+            return False
+
+
+# The server under test
+
+def rss_kb(pid: int) -> int:
+    with open(f'/proc/{pid}/status') as f:
+        return int(next(line for line in f if line.startswith('VmRSS:')).split()[1])
+
+
+def db_bytes(path: str) -> int:
+    return sum(os.path.getsize(path + suffix) for suffix in ('', '-wal') if os.path.exists(path + suffix))
+
+
+def server_metrics(text: str) -> dict:
+    """
+    Count and mean of the server's unlabeled histograms, serialization by kind and queue wait by
+    priority, and the session cache's counters, from /metrics
+    """
+    sums, counts, sessions = {}, {}, {}
+    for line in text.split('\n'):
+        match = re.match(r'ana_session_cache_total\{result="(\w+)"\} ([\d.e+-]+)$', line)
+        if match:
+            sessions[match.group(1)] = float(match.group(2))
+        match = re.match(r'(ana_\w+)_(sum|count)(\{(?:kind|priority)="(\w+)"\})? ([\d.e+-]+)$', line)
+        if match:
+            name = match.group(1) + (f'.{match.group(4)}' if match.group(4) else '')
+            (sums if match.group(2) == 'sum' else counts)[name] = float(match.group(5))
+    histograms = {name: {'count': counts[name], 'mean': sums[name] / counts[name] if counts[name] else None} for name in counts}
+    return histograms | {'ana_session_cache_total': sessions}
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ''
+
+
+async def fetch(port: int, path: str) -> str:
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(f'GET {path} HTTP/1.0\r\nHost: localhost\r\n\r\n'.encode())
+    data = await reader.read()
+    writer.close()
+    return data.split(b'\r\n\r\n', 1)[1].decode()
+
+
+async def wait_for_server(port: int, proc: subprocess.Popen):
+    for _ in range(200):
+        if proc.poll() is not None:
+            sys.exit(f'server exited with {proc.returncode}')
+        try:
+            await fetch(port, '/metrics')
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    sys.exit('server did not start')
+
+
+async def load(args, port: int, server: subprocess.Popen, db_path: str) -> dict:
+    await wait_for_server(port, server)
+    rss_idle, db_start = rss_kb(server.pid), db_bytes(db_path)
+
+    stats = defaultdict(int)
+    for key in ('connect', 'reconnect', 'chat_first_token', 'chat_complete'):
+        stats[key] = []
+    stats['error_types'] = defaultdict(int)
+    run_id = uuid.uuid4().hex[:6]
+    clients = [Client(f'ws://127.0.0.1:{port}/ws', f'loadtest-{run_id}-{i}', stats) for i in range(args.clients)]
+
+    async def start(i, client):
+        await asyncio.sleep(args.ramp * i / args.clients)
+        await client.run(args)
+
+    started = time.perf_counter()
+    tasks = [asyncio.create_task(start(i, c)) for i, c in enumerate(clients)]
+    # memory once everyone is connected, before the clients start leaving
+    await asyncio.sleep(args.ramp + min(5, args.duration / 2))
+    rss_connected = rss_kb(server.pid)
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    metrics_text = await fetch(port, '/metrics')
+    await asyncio.sleep(1)  # let the last batched writes flush
+    connected = len(stats['connect'])
+
+    summary = lambda xs: {'p50': percentile(xs, 0.5), 'p99': percentile(xs, 0.99), 'mean': statistics.mean(xs) if xs else None, 'n': len(xs)}
+    return {
+        'commit': git_commit(),
+        'params': vars(args) | {'out': None, 'compare': None},
+        'latency': {
+            'connect': summary(stats['connect']),
+            'reconnect': summary(stats['reconnect']),
+            'chat_first_token': summary(stats['chat_first_token']),
+            'chat_complete': summary(stats['chat_complete']),
+        },
+        'throughput': {
+            'messages_in_per_s': stats['messages_in'] / elapsed,
+            'messages_out_per_s': stats['messages_out'] / elapsed,
+            'bytes_out_per_s': stats['bytes_out'] / elapsed,
+            'bytes_in_per_s': stats['bytes_in'] / elapsed,
+            'wire_bytes_out_per_s': stats['wire_bytes_out'] / elapsed,
+            'wire_bytes_in_per_s': stats['wire_bytes_in'] / elapsed,
+            'chats_per_s': stats['chats_completed'] / elapsed,
+        },
+        'counts': {k: stats[k] for k in ('chats_sent', 'chats_completed', 'notifications', 'utterances', 'resyncs', 'errors')}
+        | {'connected': connected, 'error_types': dict(stats['error_types'])},
+        'db': {
+            'growth_bytes': db_bytes(db_path) - db_start,
+            'bytes_per_client_minute': (db_bytes(db_path) - db_start) / max(connected, 1) / (elapsed / 60),
+        },
+        'memory': {
+            'rss_idle_kb': rss_idle,
+            'rss_connected_kb': rss_connected,
+            'kb_per_connection': (rss_connected - rss_idle) / max(connected, 1),
+        },
+        'server': server_metrics(metrics_text),
+    }
+
+
+def flatten(d: dict, prefix='') -> dict:
+    out = {}
+    for k, v in d.items():
+        if isinstance(v, dict):
+            out.update(flatten(v, f'{prefix}{k}.'))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            out[f'{prefix}{k}'] = v
+    return out
+
+
+def report(results: dict, baseline: dict = None):
+    flat = flatten({k: results[k] for k in ('latency', 'throughput', 'counts', 'db', 'memory', 'server')})
+    base = flatten({k: baseline.get(k, {}) for k in ('latency', 'throughput', 'counts', 'db', 'memory', 'server')}) if baseline else {}
+    if baseline:
+        print(f'compared with {baseline.get("commit") or "baseline"}')
+    for key, value in flat.items():
+        line = f'{key:<55} {value:>14.4f}'
+        if key in base and base[key]:
+            line += f'  {(value - base[key]) / base[key] * 100:+7.1f}%'
+        print(line)
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=60, help='seconds each client stays connected')
+    parser.add_argument('--ramp', type=float, default=10, help='seconds over which clients connect')
+    parser.add_argument('--sync-every', type=float, default=10, help='seconds between checking the visible windows')
+    parser.add_argument('--window-changes', type=float, default=0.3, help='fraction of checks where the windows changed')
+    parser.add_argument('--heartbeat-every', type=float, default=60, help='seconds between heartbeats')
+    parser.add_argument('--reconnects', type=int, default=0,
+                        help='times each client disconnects and reconnects, all at once with --ramp 0')
+    parser.add_argument('--full-state', action='store_true', help='send the whole state on every check, like older clients')
+    parser.add_argument('--compression', choices=('deflate', 'none'), default='deflate', help='offer permessage-deflate or not')
+    parser.add_argument('--chat-every', type=float, default=60, help='mean seconds between chat messages per client')
+    parser.add_argument('--check-in-interval', type=int, default=30, help="server's CHECK_IN_INTERVAL")
+    parser.add_argument('--ttft', type=float, default=0.5, help='stub seconds to first token')
+    parser.add_argument('--token-delay', type=float, default=0.02, help='stub seconds between tokens')
+    parser.add_argument('--off-task', type=float, default=0.2, help='fraction of check-ins the stub says are off-task')
+    parser.add_argument('--out', help='save results as JSON')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    stub_port, port = free_port(), free_port()
+    start_stub(stub_port, ttft=args.ttft, token_delay=args.token_delay, off_task=args.off_task)
+
+    tmp = tempfile.mkdtemp()
+    db_path = os.path.join(tmp, 'loadtest.sqlite3')
+    env = {
+        **os.environ,
+        'OPENAI_API_KEY': 'loadtest', 'HOST': 'loadtest',
+        'OPENAI_BASE_URL': f'http://127.0.0.1:{stub_port}', 'OPENAI_HTTP2': '0',
+        'DB_PATH': db_path, 'COORDINATION_DB': os.path.join(tmp, 'coordination.sqlite3'),
+        'CHECK_IN_INTERVAL': str(args.check_in_interval), 'LOG_LEVEL': 'warning',
+    }
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'main:app', '--port', str(port), '--log-level', 'warning'],
+        cwd=BACKEND, env=env,
+    )
+    try:
+        results = asyncio.run(load(args, port, server, db_path))
+    finally:
+        server.terminate()
+        server.wait()
+
+    baseline = json.load(open(args.compare)) if args.compare else None
+    report(results, baseline)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    run()
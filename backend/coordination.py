@@ -0,0 +1,221 @@
+"""
+Which worker owns each machine's websocket, so the server can run as several uvicorn workers. A
+machine has one live connection, and its state and check-ins are handled by the worker holding it.
+
+A second connection for a machine either takes over (handoff, the default: the old one is usually
+a dead socket the client already gave up on) or is turned away while the old one is alive
+(reject). An owner that stops heartbeating loses its claim after `lease` seconds.
+
+Each claim also tells who the machine's previous owner was (releasing keeps it as the owner with an
+expired lease), so a worker knows if its cached state for the machine could be out of date.
+
+Backends implement _claim/_release/_owns/_refresh. SQLiteCoordinator keeps the registry in a
+sqlite file, enough for workers on one host without running anything else. Workers on several
+hosts need a shared backend (e.g. Redis or Postgres) implementing the same four methods.
+"""
+import asyncio
+import logging
+import os
+import socket
+import sqlite3
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, Optional, Set, Tuple
+
+
+log = logging.getLogger(__name__)
+
+WORKER_ID = f'{socket.gethostname()}:{os.getpid()}'
+
+
+def connection_id() -> str:
+    "A unique owner id for a connection in this worker"
+    return f'{WORKER_ID}:{uuid.uuid4().hex[:12]}'
+
+
+class Coordinator():
+    """
+    Connection ownership registry, e.g.
+        if await coordinator.claim(machine_id, owner, on_lost):
+            ...
+        await coordinator.release(machine_id, owner)
+    on_lost() is awaited when another connection takes the machine over, call `start` to notice
+    that happening in other workers.
+    """
+
+    def __init__(self, lease: float = 30, handoff: bool = True):
+        self.lease = lease
+        self.handoff = handoff
+        # this worker's connections, machine_id -> (owner, on_lost)
+        self.local: Dict[str, Tuple[str, Callable[[], Awaitable]]] = {}
+        # machine_id -> owner before the latest claim by this worker
+        self.previous: Dict[str, Optional[str]] = {}
+        self.heartbeats: Optional[asyncio.Task] = None
+
+
+    async def _claim(self, machine_id: str, owner: str) -> Tuple[bool, Optional[str]]:
+        "(claimed, the previous owner)"
+        raise NotImplementedError
+
+    async def _release(self, machine_id: str, owner: str):
+        raise NotImplementedError
+
+    async def _owns(self, machine_id: str, owner: str) -> bool:
+        raise NotImplementedError
+
+    async def _refresh(self, owned: Dict[str, str]) -> Set[str]:
+        "Extend the leases of owned {machine_id: owner}, returns the machine_ids that were taken over"
+        raise NotImplementedError
+
+
+    async def claim(self, machine_id: str, owner: str, on_lost: Callable[[], Awaitable]) -> bool:
+        "Make owner the machine's connection, False if it was rejected. previous_owner() says who had it."
+        claimed, previous_owner = await self._claim(machine_id, owner)
+        if not claimed:
+            return False
+        self.previous[machine_id] = previous_owner
+        previous = self.local.get(machine_id)
+        self.local[machine_id] = (owner, on_lost)
+        if previous and previous[0] != owner:
+            # the old connection is in this worker, no need to wait for a heartbeat to tell it
+            await self._lost(machine_id, previous[1])
+        return True
+
+
+    async def release(self, machine_id: str, owner: str):
+        if machine_id in self.local and self.local[machine_id][0] == owner:
+            del self.local[machine_id]
+        await self._release(machine_id, owner)
+
+
+    def previous_owner(self, machine_id: str) -> Optional[str]:
+        "Who owned the machine before this worker's latest claim of it, once (None if nobody)"
+        return self.previous.pop(machine_id, None)
+
+
+    async def owns(self, machine_id: str, owner: str) -> bool:
+        return await self._owns(machine_id, owner)
+
+
+    async def _lost(self, machine_id: str, on_lost: Callable[[], Awaitable]):
+        try:
+            await on_lost()
+        except Exception as e:
+            log.warning('handing over %s failed: %r', machine_id, e)
+
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            owned = {machine_id: owner for machine_id, (owner, _) in self.local.items()}
+            try:
+                lost = await self._refresh(owned)
+            except Exception as e:
+                log.warning('coordination heartbeat failed: %r', e)
+                continue
+            for machine_id in lost:
+                # unless it was claimed again locally while we were refreshing
+                entry = self.local.get(machine_id)
+                if entry and entry[0] == owned[machine_id]:
+                    del self.local[machine_id]
+                    await self._lost(machine_id, entry[1])
+
+
+    def start(self):
+        "Heartbeat this worker's connections, and hand over the ones other workers took"
+        self.heartbeats = asyncio.create_task(self._heartbeat_loop())
+
+
+    async def close(self):
+        "Stop heartbeating and release this worker's connections, so they can reconnect anywhere"
+        if self.heartbeats:
+            self.heartbeats.cancel()
+            self.heartbeats = None
+        for machine_id, (owner, _) in list(self.local.items()):
+            try:
+                await self.release(machine_id, owner)
+            except Exception as e:
+                log.warning('releasing %s failed: %r', machine_id, e)
+
+
+class SQLiteCoordinator(Coordinator):
+    "Registry in a sqlite file shared by the workers of one host"
+
+    def __init__(self, path: str, **kwargs):
+        super().__init__(**kwargs)
+        # one thread, so the connection is only ever used from it
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix='coordination')
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA busy_timeout = 5000")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS owners (
+                machine_id TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                heartbeat_at REAL NOT NULL
+            )
+        """)
+
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+
+    def _claim_sync(self, machine_id: str, owner: str) -> Tuple[bool, Optional[str]]:
+        now = time.time()
+        # IMMEDIATE so two workers claiming the same machine can't both see it free
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.conn.execute("SELECT owner, heartbeat_at FROM owners WHERE machine_id = ?", (machine_id,)).fetchone()
+            previous = row[0] if row else None
+            if row and row[0] != owner and not self.handoff and row[1] > now - self.lease:
+                return False, previous
+            self.conn.execute("INSERT OR REPLACE INTO owners (machine_id, owner, heartbeat_at) VALUES (?, ?, ?)",
+                              (machine_id, owner, now))
+            return True, previous
+        finally:
+            self.conn.execute("COMMIT")
+
+
+    def _refresh_sync(self, owned: Dict[str, str]) -> Set[str]:
+        now = time.time()
+        lost = set()
+        if not owned:
+            return lost
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            for machine_id, owner in owned.items():
+                c = self.conn.execute("UPDATE owners SET heartbeat_at = ? WHERE machine_id = ? AND owner = ?",
+                                      (now, machine_id, owner))
+                if c.rowcount == 0:
+                    lost.add(machine_id)
+        finally:
+            self.conn.execute("COMMIT")
+        return lost
+
+
+    async def _claim(self, machine_id: str, owner: str) -> Tuple[bool, Optional[str]]:
+        return await self._run(self._claim_sync, machine_id, owner)
+
+
+    async def _release(self, machine_id: str, owner: str):
+        # the row stays with an expired lease, so the next claim knows who had the machine
+        await self._run(self.conn.execute, "UPDATE owners SET heartbeat_at = 0 WHERE machine_id = ? AND owner = ?",
+                        (machine_id, owner))
+
+
+    async def _owns(self, machine_id: str, owner: str) -> bool:
+        row = await self._run(lambda: self.conn.execute(
+            "SELECT 1 FROM owners WHERE machine_id = ? AND owner = ? AND heartbeat_at > 0", (machine_id, owner)).fetchone())
+        return row is not None
+
+
+    async def _refresh(self, owned: Dict[str, str]) -> Set[str]:
+        return await self._run(self._refresh_sync, owned)
+
+
+    async def close(self):
+        await super().close()
+        self.executor.shutdown(wait=True)
+        self.conn.close()
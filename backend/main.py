@@ -1,19 +1,32 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-import sqlite3
 import os
+import csv
+import io
+import logging
 import json
-import httpx
 import time
 import asyncio
 import re
 import random
-from pydantic import BaseModel, ValidationError, Field
-from collections import defaultdict
-from datetime import datetime, timedelta, timezone
-from typing import List, Optional, Tuple
+import Levenshtein
+from pydantic import BaseModel, ValidationError, Field, PrivateAttr
+from collections import OrderedDict, defaultdict
+from contextlib import aclosing
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
 import pytz
 
+import metrics
+from coordination import SQLiteCoordinator, connection_id
+from metrics import Collected, Gauge, Histogram
+from openai_client import BACKGROUND, INTERACTIVE, DeltaAssembler, OpenAIClient, RequestDropped, SSEParser
+from scheduler import Scheduler, stagger
+from sessions import SessionCache
+from storage import Storage
+
 # run source ../.env to get path variables
 from dotenv import load_dotenv
 load_dotenv('../.env')
@@ -22,6 +35,15 @@ load_dotenv('../.env')
 OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
 HOST = os.environ["HOST"]
 
+logging.basicConfig(
+    level=os.environ.get("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+)
+log = logging.getLogger(__name__)
+if log.getEffectiveLevel() > logging.DEBUG:
+    # a line for every OpenAI request otherwise
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
 
 # Developed in playground.
 # TODO: Make configurable by users.
@@ -49,6 +71,42 @@ INITIAL_MESSAGE = """
 Hi! I'm your assistant Ana. How would you like to spend your time?
 """.strip()
 
+# clients at this protocol version or newer get "patch" messages instead of the full state
+PATCH_PROTOCOL = 2
+# and at this one "drop" ops when older messages leave the window, instead of the full state
+HISTORY_PROTOCOL = 3
+
+# messages kept in memory and on the client. past a quarter more, the oldest are archived (they're
+# only in the database) and the client fetches them with "history" requests, up to HISTORY_PAGE at a time
+MESSAGE_WINDOW = int(os.environ.get("MESSAGE_WINDOW", 200))
+HISTORY_PAGE = 200
+
+# write a compacted snapshot of a user's messages after this many message events
+SNAPSHOT_EVERY = 100
+
+# seconds between check-ins, overriding the client's setting (shorter for load tests)
+CHECK_IN_INTERVAL = int(os.environ.get("CHECK_IN_INTERVAL", 600))
+
+# max (approximate) tokens of conversation sent to GPT, the rest of the context window is for the reply
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", 6000))
+# activity reports older than the last few are dropped from the GPT context
+CONTEXT_ACTIVITY_REPORTS = int(os.environ.get("CONTEXT_ACTIVITY_REPORTS", 3))
+
+# activity reports are cut at this many lines / (approximate) tokens, shortest times first
+ACTIVITY_REPORT_MAX_LINES = int(os.environ.get("ACTIVITY_REPORT_MAX_LINES", 30))
+ACTIVITY_REPORT_MAX_TOKENS = int(os.environ.get("ACTIVITY_REPORT_MAX_TOKENS", 400))
+# window titles of an app at least this similar (Levenshtein ratio, normalized) are reported as one
+TITLE_SIMILARITY = float(os.environ.get("TITLE_SIMILARITY", 0.8))
+
+# bucket sizes (seconds) activity time is rolled up into. summaries use the coarsest buckets that fit.
+ROLLUP_RESOLUTIONS = (60, 60*60)
+
+# seconds between the app's heartbeats (ConnectionManager.heartbeatInterval). unchanged windows are
+# recorded again once a heartbeat interval, and a sample counts for at most two: past that the
+# client was gone (asleep, offline) without closing the connection
+HEARTBEAT_INTERVAL = int(os.environ.get("HEARTBEAT_INTERVAL", 60))
+SAMPLE_MAX_SECONDS = 2 * HEARTBEAT_INTERVAL
+
 app = FastAPI()
 
 
@@ -73,67 +131,355 @@ def setup_db(conn):
                 FOREIGN KEY(user_id) REFERENCES users(id)
             )
         """)
+    migrate_db(conn)
 
 
-@app.on_event("startup")
-def startup():
-    app.state.db = sqlite3.connect("db.sqlite3")
-    setup_db(app.state.db)
+def migrate_db(conn):
+    "Apply every migration newer than the database's user_version, each in its own transaction"
+    for i, migration in enumerate(MIGRATIONS, start=1):
+        with conn:
+            # IMMEDIATE takes the write lock before checking the version, so when several workers
+            # start at once one of them applies the migration and the others see it applied
+            conn.execute("BEGIN IMMEDIATE")
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= i:
+                continue
+            log.info('migrating db to version %d: %s', i, migration.__name__)
+            migration(conn.cursor())
+            conn.execute(f"PRAGMA user_version = {i}")
 
 
-@app.on_event("shutdown")
-def shutdown():
-    app.state.db.close()
+def migrate_activity_samples(c):
+    """
+    Normalized activity storage, so check-ins don't have to parse whole app_states blobs.
+    Samples are keyed by (user_id, ts) and their windows point into interned app/title tables.
+    """
+    c.execute("CREATE TABLE apps (id INTEGER PRIMARY KEY, name TEXT UNIQUE)")
+    c.execute("CREATE TABLE window_titles (id INTEGER PRIMARY KEY, title TEXT UNIQUE)")
+    c.execute("""
+        CREATE TABLE activity_samples (
+            user_id INTEGER,
+            ts INTEGER, -- unix time
+
+            PRIMARY KEY (user_id, ts),
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        ) WITHOUT ROWID
+    """)
+    c.execute("""
+        CREATE TABLE activity_windows (
+            user_id INTEGER,
+            ts INTEGER,
+            app_id INTEGER,
+            title_id INTEGER,
+
+            FOREIGN KEY(app_id) REFERENCES apps(id),
+            FOREIGN KEY(title_id) REFERENCES window_titles(id)
+        )
+    """)
+    c.execute("CREATE INDEX activity_windows_user_ts ON activity_windows (user_id, ts)")
+
+    # backfill from the existing app_states rows (created_at is UTC)
+    rows = c.connection.execute("""
+        SELECT user_id, CAST(strftime('%s', created_at) AS INTEGER),
+               json_extract(state_json, '$.activity.visibleWindows')
+        FROM app_states ORDER BY id
+    """)
+    for user_id, ts, windows in rows:
+        if user_id is None or ts is None:
+            continue
+        insert_activity_sample(c, user_id, ts, json.loads(windows or '[]'))
+
+
+def migrate_state_events(c):
+    """
+    Event-sourced app state, instead of a full AppState row on every save.
+    * message_events: append-only log. A row (idx, message) truncates the conversation to idx
+      messages then appends message, a NULL message_json only truncates. The id is the message id.
+    * user_states: one small row per user with everything but the messages (settings, activity...)
+    * state_snapshots: the full message list as of event_id, so rebuilding doesn't replay everything.
+    """
+    c.execute("""
+        CREATE TABLE message_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            user_id INTEGER,
+            idx INTEGER,
+            message_json TEXT,
+
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    """)
+    c.execute("CREATE INDEX message_events_user_id ON message_events (user_id, id)")
+    c.execute("""
+        CREATE TABLE user_states (
+            user_id INTEGER PRIMARY KEY,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            state_json TEXT,
+
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    """)
+    c.execute("""
+        CREATE TABLE state_snapshots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            user_id INTEGER,
+            event_id INTEGER,
+            messages_json TEXT,
+
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    """)
+    c.execute("CREATE INDEX state_snapshots_user_id ON state_snapshots (user_id, id)")
+
+    # seed from each user's most recent app_states row
+    rows = c.connection.execute("""
+        SELECT user_id, state_json FROM app_states
+        WHERE id IN (SELECT MAX(id) FROM app_states GROUP BY user_id)
+    """)
+    for user_id, state_json in rows:
+        try:
+            state = json.loads(state_json)
+        except json.JSONDecodeError:
+            continue
+        messages = state.pop('messages', [])
+        c.executemany("INSERT INTO message_events (user_id, idx, message_json) VALUES (?, ?, ?)", [
+            (user_id, i, json.dumps(m)) for i, m in enumerate(messages)
+        ])
+        c.execute("""
+            INSERT INTO state_snapshots (user_id, event_id, messages_json)
+            SELECT ?, MAX(id), ? FROM message_events WHERE user_id = ?
+        """, (user_id, json.dumps(messages), user_id))
+        c.execute("INSERT INTO user_states (user_id, state_json) VALUES (?, ?)", (user_id, json.dumps(state)))
 
 
-openai = httpx.AsyncClient(
-    base_url="https://api.openai.com",
-    headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
-    timeout=100,
-)
+def migrate_activity_rollups(c):
+    """
+    Seconds spent on each (app, title) per user and time bucket, for every resolution in
+    ROLLUP_RESOLUTIONS. Kept up to date by record_activity so summaries are a small range-sum.
+    """
+    c.execute("""
+        CREATE TABLE activity_rollups (
+            user_id INTEGER,
+            resolution INTEGER,
+            bucket INTEGER, -- unix time the bucket starts at, a multiple of resolution
+            app_id INTEGER,
+            title_id INTEGER,
+            seconds INTEGER,
+
+            PRIMARY KEY (user_id, resolution, bucket, app_id, title_id)
+        ) WITHOUT ROWID
+    """)
+
+    # backfill from consecutive samples
+    prev = None
+    for user_id, ts in c.connection.execute("SELECT user_id, ts FROM activity_samples ORDER BY user_id, ts").fetchall():
+        if prev and prev[0] == user_id:
+            add_rollup(c, user_id, prev[1], ts, sample_windows(c, user_id, prev[1]))
+        prev = (user_id, ts)
+
+
+def migrate_app_states_index(c):
+    "app_states was only ever scanned in full, per user and by time is how it's looked up"
+    c.execute("CREATE INDEX IF NOT EXISTS app_states_user_created ON app_states (user_id, created_at)")
+
+
+def migrate_check_ins(c):
+    "Check-in times per user, so they survive restarts (and don't all fire at once after one)"
+    c.execute("""
+        CREATE TABLE check_ins (
+            user_id INTEGER PRIMARY KEY,
+            last_check_in REAL,
+            next_check_in REAL,
+            last_interrupt REAL,
+
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    """)
 
 
-async def stream_completion(body):
-    def _update(delta, data):
-        for k, v in delta.items():
-            if isinstance(data.get(k), str):
-                data[k] += v
-            elif isinstance(data.get(k), dict):
-                data[k] = _update(v, data[k])
-            else:
-                data[k] = v
-        return data
+def migrate_history_window(c):
+    """
+    Handlers keep only the newest messages, the snapshot holds that window: the index of its first
+    message and the archived messages the GPT context keeps (system prompt, the user's goal).
+    History pages are read from message_events by index.
+    """
+    c.execute("ALTER TABLE state_snapshots ADD COLUMN history_offset INTEGER NOT NULL DEFAULT 0")
+    c.execute("ALTER TABLE state_snapshots ADD COLUMN pinned_json TEXT NOT NULL DEFAULT '[]'")
+    c.execute("CREATE INDEX message_events_user_idx ON message_events (user_id, idx, id)")
+
+
+# setup_db applies these in order, PRAGMA user_version is how many have been applied. Only append.
+MIGRATIONS = [
+    migrate_activity_samples,
+    migrate_state_events,
+    migrate_activity_rollups,
+    migrate_app_states_index,
+    migrate_check_ins,
+    migrate_history_window,
+]
 
-    # preserve object identity across chunks
-    message = Message(role='')
-    data = {}
-    async with openai.stream(
-        method='POST',
-        url="/v1/chat/completions",
-        json={**body, "stream": True},
-    ) as resp:
-        if resp.status_code != 200:
-            # read response and raise error
-            raise Exception((await resp.aread()).decode())
-
-        # chunks are "data: {json}\n\n"
-        async for chunk in resp.aiter_lines():
-            if not chunk.startswith("data: "):
-                continue
-            data_str = chunk.split("data: ")[1].strip()
-            resp_json = json.loads(data_str)
-            choice = resp_json['choices'][0]
-            delta = choice.get('delta')
-            if choice['finish_reason'] or delta is None:
-                break
 
-            data = _update(delta, data)
+def intern(c, table: str, column: str, value: str) -> int:
+    "Get the id of value in a dictionary table (apps, window_titles), inserting it if needed"
+    c.execute(f"INSERT OR IGNORE INTO {table} ({column}) VALUES (?)", (value,))
+    return c.execute(f"SELECT id FROM {table} WHERE {column} = ?", (value,)).fetchone()[0]
 
-            message.role, message.content = data['role'], data.get('content')
-            if data.get('function_call'):
-                message.function_call = FunctionCall.model_validate(data['function_call'])
-            assert message.role, f'No role set for message {message}'
-            yield message
+
+def insert_activity_sample(c, user_id: int, ts: int, windows: List['Window']):
+    "Record the visible windows of user_id at unix time ts, replacing any sample at the same second"
+    c.execute("INSERT OR IGNORE INTO activity_samples (user_id, ts) VALUES (?, ?)", (user_id, ts))
+    c.execute("DELETE FROM activity_windows WHERE user_id = ? AND ts = ?", (user_id, ts))
+    c.executemany("INSERT INTO activity_windows (user_id, ts, app_id, title_id) VALUES (?, ?, ?, ?)", [
+        (
+            user_id, ts,
+            intern(c, 'apps', 'name', w['kCGWindowOwnerName']),
+            intern(c, 'window_titles', 'title', w['kCGWindowName']),
+        )
+        for w in windows
+    ])
+
+
+def sample_windows(c, user_id: int, ts: int) -> List[Tuple[int, int]]:
+    "(app_id, title_id) of the windows in a sample"
+    return c.execute("SELECT app_id, title_id FROM activity_windows WHERE user_id = ? AND ts = ?", (user_id, ts)).fetchall()
+
+
+def add_rollup(c, user_id: int, start: int, end: int, windows: List[Tuple[int, int]]):
+    "Add the time between start and end (at most SAMPLE_MAX_SECONDS) to each window's rollup buckets"
+    end = min(end, start + SAMPLE_MAX_SECONDS)
+    for resolution in ROLLUP_RESOLUTIONS:
+        bucket = start - start % resolution
+        while bucket < end:
+            seconds = min(end, bucket + resolution) - max(start, bucket)
+            c.executemany("""
+                INSERT INTO activity_rollups (user_id, resolution, bucket, app_id, title_id, seconds)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT DO UPDATE SET seconds = seconds + excluded.seconds
+            """, [(user_id, resolution, bucket, app_id, title_id, seconds) for app_id, title_id in windows])
+            bucket += resolution
+
+
+def record_activity(c, user_id: int, ts: int, windows: List['Window']):
+    "Insert an activity sample, closing the previous sample's interval in the rollups"
+    prev = c.execute("SELECT MAX(ts) FROM activity_samples WHERE user_id = ?", (user_id,)).fetchone()[0]
+    if prev is not None and prev < ts:
+        add_rollup(c, user_id, prev, ts, sample_windows(c, user_id, prev))
+    insert_activity_sample(c, user_id, ts, windows)
+
+
+@app.on_event("startup")
+async def startup():
+    app.state.db = Storage(
+        os.environ.get("DB_PATH", "db.sqlite3"),
+        readers=int(os.environ.get("DB_READERS", 4)),
+        batch_size=int(os.environ.get("DB_BATCH_SIZE", 256)),
+        flush_interval=float(os.environ.get("DB_FLUSH_INTERVAL", 0.5)),
+    )
+    await app.state.db.write(setup_db)
+    app.state.db.start()
+    app.state.scheduler = Scheduler()
+    app.state.scheduler.start()
+    # shared by the workers (uvicorn --workers N), so each machine's connection has one owner
+    app.state.coordinator = SQLiteCoordinator(
+        os.environ.get("COORDINATION_DB", "coordination.sqlite3"),
+        lease=float(os.environ.get("COORDINATION_LEASE", 30)),
+        handoff=os.environ.get("DUPLICATE_CONNECTIONS", "handoff") == "handoff",
+    )
+    app.state.coordinator.start()
+    # what reconnecting clients would otherwise load from the database, see sessions.py
+    app.state.sessions = SessionCache(
+        size=int(os.environ.get("SESSION_CACHE_SIZE", 10000)),
+        ttl=float(os.environ.get("SESSION_CACHE_TTL", 600)),
+    )
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.scheduler.stop()
+    await app.state.coordinator.close()
+    await app.state.db.close()
+    await openai.aclose()
+
+
+openai = OpenAIClient(
+    api_key=OPENAI_API_KEY,
+    base_url=os.environ.get("OPENAI_BASE_URL", "https://api.openai.com"),
+    http2=os.environ.get("OPENAI_HTTP2", "1") == "1",
+    max_connections=int(os.environ.get("OPENAI_MAX_CONNECTIONS", 20)),
+    max_in_flight=int(os.environ.get("OPENAI_MAX_IN_FLIGHT", 16)),
+    interactive_reserve=int(os.environ.get("OPENAI_INTERACTIVE_RESERVE", 4)),
+    max_retries=int(os.environ.get("OPENAI_MAX_RETRIES", 3)),
+)
+
+
+# served on /metrics, see metrics.py
+CHECK_IN_SECONDS = Histogram('ana_check_in_seconds', 'Check-ins, from starting to the reply sent (or not)')
+CHECK_IN_DECISION_SECONDS = Histogram(
+    'ana_check_in_decision_seconds', 'Check-in completions, from the request to knowing if the user is on task')
+COMPLETION_FIRST_TOKEN_SECONDS = Histogram(
+    'ana_openai_time_to_first_token_seconds', 'Streamed completions, from the request to the first delta')
+COMPLETION_SECONDS = Histogram(
+    'ana_openai_completion_seconds', 'Streamed completions, from the request to the end of the stream or hanging up')
+WS_MESSAGE_CHARS = Histogram(
+    'ana_ws_message_chars', 'Websocket message sizes in characters', ('direction', 'type'), buckets=metrics.SIZE_BUCKETS)
+# label values for what clients send, anything else is counted as 'other' so clients can't add series
+CLIENT_MESSAGE_TYPES = {'state', 'activity', 'heartbeat', 'resync', 'history'}
+SERIALIZATION_SECONDS = Histogram(
+    'ana_state_serialization_seconds', 'Serializing state to send (state or patch) or to save', ('kind',))
+CONNECTIONS = Gauge('ana_ws_connections', 'Open websocket connections, by the compression the client offered', ('compression',))
+Collected('ana_openai_in_flight', 'Completions holding a slot', 'gauge', lambda: openai.counters['in_flight'])
+Collected('ana_openai_queued', 'Completions waiting for a slot, by priority class', 'gauge', openai.queued, label='priority')
+Collected('ana_openai_requests_total', 'OpenAI API requests, retries, failed requests and requests dropped while waiting',
+          'counter', lambda: {k: openai.counters[k] for k in ('requests', 'retries', 'failures', 'expired', 'superseded')},
+          label='event')
+Collected('ana_db_queued_writes', 'Writes waiting for the next batch', 'gauge', lambda: app.state.db.stats()['queue_depth'])
+Collected('ana_db_batches_total', 'Batched write flushes, writes flushed and writes that failed', 'counter',
+          lambda: {k: app.state.db.counters[k] for k in ('flushes', 'flushed_writes', 'failed_writes')}, label='event')
+Collected('ana_session_cache_total', 'Registrations restored from the session cache (hits) or not, and loads shared',
+          'counter', lambda: app.state.sessions.counters, label='result')
+Collected('ana_verdict_cache_total', 'Check-ins that skipped GPT (hits) or not', 'counter', lambda: VerdictCache.stats, label='result')
+Collected('ana_title_clusters_total', 'Window titles labelled from the cache (hits) or by comparing with clusters (misses)',
+          'counter', lambda: TitleClusters.stats, label='result')
+Collected('ana_check_in_replies_total', 'Check-in replies cut short once on-task, or read in full', 'counter',
+          lambda: VerdictParser.stats, label='reply')
+
+
+async def stream_completion(body, priority: int = INTERACTIVE, deadline: Optional[float] = None, key=None):
+    """
+    Stream the first choice of a chat completion, yielding the same Message, updated, as it arrives.
+    priority, deadline and key are for waiting for a slot, see OpenAIClient.stream.
+    """
+    # preserve object identity across chunks
+    message = Message(role='')
+    parser, assembler = SSEParser(), DeltaAssembler()
+    start = time.perf_counter()
+    try:
+        async with openai.stream("/v1/chat/completions", json={**body, "stream": True},
+                                 priority=priority, deadline=deadline, key=key) as resp:
+            if resp.status_code != 200:
+                # read response and raise error
+                raise Exception((await resp.aread()).decode())
+
+            # one update per read, however many events it had
+            async for chunk in resp.aiter_bytes():
+                for data in parser.feed(chunk):
+                    assembler.add(data)
+
+                choice = assembler.choices.get(0)
+                if choice and choice.changed:
+                    if not message.role:
+                        COMPLETION_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - start)
+                    choice.changed = False
+                    message.role, message.content = choice.role, choice.content
+                    if choice.has_function_call:
+                        message.function_call = FunctionCall.model_construct(**choice.function_call)
+                    assert message.role, f'No role set for message {message}'
+                    yield message
+
+                if assembler.finished:
+                    break
+    finally:
+        COMPLETION_SECONDS.observe(time.perf_counter() - start)
 
 
 # Pydantic models for app state
@@ -148,6 +494,11 @@ class Message(BaseModel):
     function_call: Optional[FunctionCall] = None
     time: Optional[float] = time.time()
 
+    # (content, function_call) -> token count
+    _tokens: Optional[Tuple[tuple, int]] = PrivateAttr(default=None)
+    # dump_json(), dropped whenever a field is set
+    _json: Optional[str] = PrivateAttr(default=None)
+
     def model_dump(self, **kwargs):
         return super().model_dump(exclude_none=True, **kwargs)
 
@@ -155,6 +506,84 @@ class Message(BaseModel):
         # model dump only the fields that openai needs
         return self.model_dump(exclude={'time'})
 
+    def key(self):
+        "Cheap change detection, strings compare by identity first so unchanged messages are O(1)"
+        return (self.role, self.content, self.function_call, self.time)
+
+    def tokens(self) -> int:
+        "Approximate token count for the OpenAI API, cached until the message changes"
+        key = (self.content, self.function_call)
+        if self._tokens is None or self._tokens[0] != key:
+            text = (self.content or '') + (self.function_call.model_dump_json() if self.function_call else '')
+            # ~4 characters per token, punctuation on its own, plus per-message overhead
+            self._tokens = (key, len(TOKEN_RE.findall(text)) + 4)
+        return self._tokens[1]
+
+    def is_activity_report(self) -> bool:
+        return self.role == 'user' and (self.content or '').startswith('[ACTIVITY REPORT]')
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if not name.startswith('_'):
+            self.__pydantic_private__['_json'] = None
+
+    def dump_json(self) -> str:
+        """
+        JSON of model_dump(), cached until the message changes. Finished messages never do, so
+        only the one being streamed is serialized again for each state sent or saved.
+        """
+        # through the private dict, self._json is several times slower than serializing the message
+        private = self.__pydantic_private__
+        if private['_json'] is None:
+            private['_json'] = self.model_dump_json(exclude_none=True)
+        return private['_json']
+
+
+def json_list(fragments) -> str:
+    "JSON list of already serialized items"
+    return '[' + ','.join(fragments) + ']'
+
+
+TOKEN_RE = re.compile(r"\w{1,4}|[^\w\s]")
+
+
+def build_context(messages: List[Message], budget: int = CONTEXT_TOKEN_BUDGET,
+                  activity_reports: int = CONTEXT_ACTIVITY_REPORTS) -> List[dict]:
+    """
+    Dump messages for the OpenAI API within a token budget. The system prompt and the user's first
+    message (their stated goal) are always kept, then the most recent messages that fit. Only the
+    last few activity reports are kept, a note says how much older conversation was left out.
+    """
+    messages = [m for m in messages if m.role in ('user', 'assistant', 'function', 'system')]
+    system = next((m for m in messages if m.role == 'system'), None)
+    goal = next((m for m in messages if m.role == 'user' and not m.is_activity_report()), None)
+    pinned = [m for m in (system, goal) if m is not None]
+
+    # older reports go together with the reply to them
+    reports = [i for i, m in enumerate(messages) if m.is_activity_report()]
+    old_reports = reports[:max(len(reports) - activity_reports, 0)]
+    skip = set(old_reports) | {i + 1 for i in old_reports if i + 1 < len(messages) and messages[i + 1].role == 'assistant'}
+
+    budget -= sum(m.tokens() for m in pinned)
+    kept = {i for i, m in enumerate(messages) if any(m is p for p in pinned)}
+    dropped = 0
+    for i in reversed(range(len(messages))):
+        if i in skip or i in kept:
+            continue
+        if messages[i].tokens() > budget:
+            # keep the recent turns contiguous, everything older is dropped
+            dropped += 1
+            budget = 0
+            continue
+        budget -= messages[i].tokens()
+        kept.add(i)
+
+    context = [messages[i].openai_dump() for i in sorted(kept)]
+    if dropped or old_reports:
+        note = {"role": "system", "content": f"[{dropped} older messages and {len(old_reports)} older activity reports omitted]"}
+        context.insert(1 if system else 0, note)
+    return context
+
 
 class PromptPair(BaseModel):
     trigger: str
@@ -180,64 +609,418 @@ class AppState(BaseModel):
     machine_id: str = Field(..., alias='machineId')
     username: str
     version: Optional[str] = None
+    protocol_version: int = Field(1, alias='protocolVersion')
+    # index of messages[0] in the whole conversation, the ones before it are archived
+    history_offset: int = Field(0, alias='historyOffset')
     messages: List[Message]
     settings: Settings
     activity: Activity
 
+    def dump_json(self) -> str:
+        "JSON of model_dump(by_alias=True), with the messages' cached JSON spliced in"
+        state = self.model_dump_json(by_alias=True, exclude={'messages'})
+        return state[:-1] + ',"messages":' + json_list(m.dump_json() for m in self.messages) + '}'
 
 
-def get_activity_times(user_id: int, db, start: datetime, end: datetime):
-    """Get activity times. Start and end should be in the user's localtime."""
+
+def get_activity_times(db, user_id: int, start: datetime, end: datetime, cluster: Optional[Callable[[str, str], str]] = None):
+    """
+    Get activity times. Start and end should be in the user's localtime.
+    cluster(app, title) gives the title to report a window under, to merge similar ones.
+    """
 
     cur = db.cursor()
+    start_ts, end_ts = int(start.timestamp()), int(end.timestamp())
+
+    # whole hours from the hour buckets, the minutes around them from the minute buckets
+    minute, hour = ROLLUP_RESOLUTIONS
+    first_hour, last_hour = -(-start_ts // hour) * hour, end_ts // hour * hour
+    if first_hour < last_hour:
+        ranges = [(minute, start_ts, first_hour), (hour, first_hour, last_hour), (minute, last_hour, end_ts)]
+    else:
+        ranges = [(minute, start_ts, end_ts)]
+
+    seconds = defaultdict(int)
     query = '''
-    SELECT json_extract(state_json, '$.activity'), created_at
-    FROM app_states WHERE created_at BETWEEN ? and ? AND user_id = ?
-    ORDER BY created_at ASC
+    SELECT app_id, title_id, SUM(seconds) FROM activity_rollups
+    WHERE user_id = ? AND resolution = ? AND bucket >= ? AND bucket < ?
+    GROUP BY app_id, title_id
     '''
-    # convert start, end into UTC time (from local time) to match the database
-    db_start, db_end = start.astimezone(timezone.utc), end.astimezone(timezone.utc)
-    cur.execute(query, (db_start.strftime('%Y-%m-%d %H:%M:%S'), db_end.strftime('%Y-%m-%d %H:%M:%S'), user_id))
+    for resolution, range_start, range_end in ranges:
+        for app_id, title_id, secs in cur.execute(query, (user_id, resolution, range_start, range_end)):
+            seconds[app_id, title_id] += secs
+
+    # the latest sample's interval isn't closed (rolled up) yet, it lasts until now (or its max)
+    latest = cur.execute("SELECT MAX(ts) FROM activity_samples WHERE user_id = ?", (user_id,)).fetchone()[0]
+    if latest is not None and latest < end_ts:
+        open_seconds = min(end_ts, latest + SAMPLE_MAX_SECONDS) - max(latest, start_ts)
+        for app_id, title_id in sample_windows(cur, user_id, latest) if open_seconds > 0 else []:
+            seconds[app_id, title_id] += open_seconds
 
-    rows = cur.fetchall()
-    activity = [Activity.model_validate_json(a) for a, _ in rows]
-    times = [datetime.strptime(t, '%Y-%m-%d %H:%M:%S') for _, t in rows]
-    # convert times from utc to the same timezone as end
-    times = [t.replace(tzinfo=timezone.utc).astimezone(end.tzinfo) for t in times]
-    times.append(end)
+    app_names = lookup_names(cur, 'apps', 'name', {app_id for app_id, _ in seconds})
+    titles = lookup_names(cur, 'window_titles', 'title', {title_id for _, title_id in seconds})
 
     app_time = defaultdict(int)
     title_time = defaultdict(lambda: defaultdict(int))
+    for (app_id, title_id), secs in seconds.items():
+        app, title = app_names[app_id], titles[title_id]
+        app_time[app] += secs
+        title_time[app][cluster(app, title) if cluster else title] += secs
+
+    # remove apps & titles with <1min activity time (noise). after merging, so many short visits
+    # to similar windows still add up.
+    app_time = {app: round(t / 60) for app, t in app_time.items() if round(t / 60) > 1}
+    title_time = {
+        app: {title: round(t / 60) for title, t in title_t.items() if round(t / 60) > 1}
+        for app, title_t in title_time.items()
+    }
+    return app_time, title_time
 
-    for i in range(len(activity)):
-        time_diff = round((times[i+1] - times[i]).seconds / 60)  # in minutes
 
-        for win in activity[i].visible_windows:
-            ownerName, windowName = win['kCGWindowOwnerName'], win['kCGWindowName']
-            app_time[ownerName] += time_diff
-            title_time[ownerName][windowName] += time_diff
+def lookup_names(c, table: str, column: str, ids) -> dict:
+    "Map ids from a dictionary table back to their values"
+    ids = list(ids)
+    rows = c.execute(f"SELECT id, {column} FROM {table} WHERE id IN ({','.join('?' * len(ids))})", ids)
+    return dict(rows.fetchall())
 
-    # remove apps & titles with <1min activity time (noise)
-    app_time = {app: t for app, t in app_time.items() if t > 1}
-    title_time = {app: {title: t for title, t in title_t.items() if t > 1} for app, title_t in title_time.items()}
-    return app_time, title_time
 
+def load_user_timezone(db, machine_id: str) -> Optional[Tuple[int, str]]:
+    "(user_id, timezone setting) of a machine, None if it never registered"
+    row = db.execute("""
+        SELECT users.id, json_extract(user_states.state_json, '$.settings.timezone')
+        FROM users LEFT JOIN user_states ON user_states.user_id = users.id
+        WHERE users.machine_id = ?
+    """, (machine_id,)).fetchone()
+    return (row[0], row[1] or 'UTC') if row else None
 
-def get_activity_summary_from_times(app_time, title_time, start: datetime, end: datetime) -> str:
-    # TODO: Track user local timezone
-    result = f"Activity report between {start.strftime('%I:%M%p')} and {end.strftime('%I:%M%p')}:\n"
-    for app, app_t in app_time.items():
-        result += f"- {app_t}min on {app}\n"
-        for title, title_t in title_time[app].items():
-            result += f"    - {title_t}min on {title}\n"
 
+def query_activity_export(db, user_id: int, start_ts: int, end_ts: int):
+    """
+    Cursor over (ts, app, title) of the samples in [start_ts, end_ts] ordered by time, starting
+    with the sample that was current at start_ts. A sample without windows has one row of Nones.
+    """
+    current = db.execute("SELECT MAX(ts) FROM activity_samples WHERE user_id = ? AND ts <= ?", (user_id, start_ts)).fetchone()[0]
+    return db.execute("""
+        SELECT activity_samples.ts, apps.name, window_titles.title
+        FROM activity_samples
+        LEFT JOIN activity_windows ON activity_windows.user_id = activity_samples.user_id AND activity_windows.ts = activity_samples.ts
+        LEFT JOIN apps ON apps.id = activity_windows.app_id
+        LEFT JOIN window_titles ON window_titles.id = activity_windows.title_id
+        WHERE activity_samples.user_id = ? AND activity_samples.ts >= ? AND activity_samples.ts <= ?
+        ORDER BY activity_samples.ts
+    """, (user_id, start_ts if current is None else current, end_ts))
+
+
+async def activity_export_samples(batches: AsyncIterator[List[tuple]], start_ts: int, end_ts: int):
+    """
+    Group batches of query_activity_export rows into lists of (ts, seconds, [(app, title)]) samples.
+    A sample lasts until the next one (at most SAMPLE_MAX_SECONDS), clipped to the range, same as
+    get_activity_times counts it.
+    """
+    end_ts = min(end_ts, int(time.time()))
+
+    def span(ts: int, until: int) -> Tuple[int, int]:
+        begin = max(ts, start_ts)
+        return begin, max(min(until, ts + SAMPLE_MAX_SECONDS) - begin, 0)
+
+    sample: Optional[Tuple[int, list]] = None
+    async for rows in batches:
+        samples = []
+        for ts, app, title in rows:
+            if sample and sample[0] != ts:
+                samples.append((*span(sample[0], ts), sample[1]))
+                sample = None
+            if sample is None:
+                sample = (ts, [])
+            if app is not None:
+                sample[1].append((app, title))
+        yield samples
+    if sample and sample[0] < end_ts:
+        yield [(*span(sample[0], end_ts), sample[1])]
+
+
+def get_activity_summary_from_times(app_time, title_time, start: datetime, end: datetime,
+                                    max_lines: int = ACTIVITY_REPORT_MAX_LINES, max_tokens: int = ACTIVITY_REPORT_MAX_TOKENS) -> str:
+    """
+    Apps and their titles, longest first. Past max_lines lines or about max_tokens tokens, apps that
+    don't fit are totalled on one line so the report still accounts for their time, then the
+    shortest titles are left out.
+    """
+    # TODO: Track user local timezone
+    header = f"Activity report between {start.strftime('%I:%M%p')} and {end.strftime('%I:%M%p')}:\n"
+    # room for the header and the line totalling what's left out
+    lines, tokens = 2, len(TOKEN_RE.findall(header)) + 10
+
+    apps, other_apps, other_t = [], 0, 0
+    for app, app_t in sorted(app_time.items(), key=lambda item: -item[1]):
+        line = f"- {app_t}min on {app}\n"
+        if other_apps or lines >= max_lines or tokens + len(TOKEN_RE.findall(line)) > max_tokens:
+            other_apps, other_t = other_apps + 1, other_t + app_t
+            continue
+        apps.append((app, line))
+        lines, tokens = lines + 1, tokens + len(TOKEN_RE.findall(line))
+
+    titles = defaultdict(list)
+    for title_t, app, title in sorted(((t, app, title) for app, _ in apps for title, t in title_time.get(app, {}).items()),
+                                      key=lambda item: -item[0]):
+        line = f"    - {title_t}min on {title}\n"
+        if lines >= max_lines or tokens + len(TOKEN_RE.findall(line)) > max_tokens:
+            break
+        titles[app].append(line)
+        lines, tokens = lines + 1, tokens + len(TOKEN_RE.findall(line))
+
+    result = header + ''.join(line + ''.join(titles[app]) for app, line in apps)
+    if other_apps:
+        result += f"- {other_t}min on {other_apps} other apps\n"
     return result
 
 
-# TODO: Add merging of similar titled apps, possibly summarizing by an LLM
-def get_activity_summary_from_db(user_id: int, db, start: datetime, end: datetime) -> str:
-    app_time, title_time = get_activity_times(user_id, db, start, end)
-    return get_activity_summary_from_times(app_time, title_time, start, end)
+@lru_cache(maxsize=4096)
+def normalize_title(title: str) -> str:
+    "What's left of a window title without the parts that change while it's the same window: unread counts, numbers, case"
+    title = re.sub(r'^\(\d+\+?\)\s*', '', title.lower())  # "(3) Inbox"
+    return ' '.join(re.sub(r'\d+', '#', title).split())
+
+
+class TitleClusters():
+    """
+    A user's window titles grouped by similarity, so reports list a site's tabs, a project's files
+    or a chat's threads once. A title joins the first cluster of its app whose normalized title is
+    within `similarity`, and is reported under that cluster's first title.
+
+    Titles already placed are remembered (LRU), so a check-in only compares the new ones.
+    """
+    # across all connections
+    stats = {'hits': 0, 'misses': 0}
+
+    def __init__(self, size: int = 4096, clusters: int = 256, similarity: float = TITLE_SIMILARITY):
+        self.size = size
+        self.max_clusters = clusters
+        self.similarity = similarity
+        # (app, title) -> title it's reported as
+        self.labels: OrderedDict[Tuple[str, str], str] = OrderedDict()
+        # app -> {normalized first title: first title}, most recently used last
+        self.clusters: Dict[str, OrderedDict[str, str]] = defaultdict(OrderedDict)
+
+    def label(self, app: str, title: str) -> str:
+        key = (app, title)
+        if key in self.labels:
+            self.labels.move_to_end(key)
+            self.stats['hits'] += 1
+            return self.labels[key]
+        self.stats['misses'] += 1
+
+        normalized = normalize_title(title)
+        clusters = self.clusters[app]
+        head = normalized if normalized in clusters else next(
+            (other for other in clusters if Levenshtein.ratio(normalized, other, score_cutoff=self.similarity)), None)
+        if head is None:
+            head = normalized
+            clusters[head] = title
+            if len(clusters) > self.max_clusters:
+                clusters.popitem(last=False)
+        clusters.move_to_end(head)
+
+        self.labels[key] = clusters[head]
+        if len(self.labels) > self.size:
+            self.labels.popitem(last=False)
+        return clusters[head]
+
+    def clear(self):
+        self.labels.clear()
+        self.clusters.clear()
+
+
+def load_user_id(db, machine_id: str, username: Optional[str] = None) -> Optional[int]:
+    "get user_id from machine_id, registering the machine if username is given"
+    c = db.cursor()
+    if username is not None:
+        c.execute("INSERT OR IGNORE INTO users (machine_id, username) VALUES (?, ?)", (machine_id, username))
+    row = c.execute("SELECT id FROM users WHERE machine_id = ?", (machine_id,)).fetchone()
+    return row[0] if row else None
+
+
+def load_app_state(db, user_id: int) -> Optional[Tuple[AppState, List[Message], str, int]]:
+    """
+    Rebuild the most recent app state from the newest snapshot plus the message events after it.
+    Returns (app_state, archived pinned messages, settings/activity json, number of events replayed).
+    """
+    c = db.cursor()
+    row = c.execute("SELECT state_json FROM user_states WHERE user_id = ?", (user_id,)).fetchone()
+    if row is None:
+        return None
+
+    snapshot = c.execute("""
+        SELECT event_id, history_offset, pinned_json, messages_json FROM state_snapshots
+        WHERE user_id = ?
+        ORDER BY id DESC
+        LIMIT 1
+    """, (user_id,)).fetchone()
+    event_id, offset, pinned_json, messages_json = snapshot or (0, 0, '[]', '[]')
+    messages = json.loads(messages_json)
+
+    events = c.execute("""
+        SELECT idx, message_json FROM message_events
+        WHERE user_id = ? AND id > ?
+        ORDER BY id ASC
+    """, (user_id, event_id or 0)).fetchall()
+    for idx, message_json in events:
+        if idx < offset:
+            # archived messages don't change, handlers only write events inside their window
+            log.warning('user %s has an event at %d, before the snapshot window at %d', user_id, idx, offset)
+        del messages[max(idx - offset, 0):]
+        if message_json is not None:
+            messages.append(json.loads(message_json))
+
+    try:
+        app_state = AppState.model_validate({**json.loads(row[0]), 'messages': messages, 'historyOffset': offset})
+        pinned = [Message.model_validate(m) for m in json.loads(pinned_json)]
+    except ValidationError as e:
+        log.warning('stored app state of user %s is invalid: %s', user_id, e)
+        return None
+    return app_state, pinned, row[0], len(events)
+
+
+def load_message_range(db, user_id: int, start: int, end: int) -> List[str]:
+    """
+    JSON of messages start to end (exclusive) of the conversation, which must be archived. The newest
+    event at an archived index is its message: a truncation before it was followed by appends past it.
+    """
+    rows = db.execute("""
+        SELECT message_json FROM message_events
+        WHERE id IN (
+            SELECT MAX(id) FROM message_events
+            WHERE user_id = ? AND idx >= ? AND idx < ?
+            GROUP BY idx
+        ) AND message_json IS NOT NULL
+        ORDER BY idx
+    """, (user_id, start, end))
+    return [message_json for message_json, in rows]
+
+
+def load_check_in(db, user_id: int) -> Optional[Tuple[float, float, float]]:
+    "(last_check_in, next_check_in, last_interrupt) of a user"
+    return db.execute("""
+        SELECT last_check_in, next_check_in, last_interrupt FROM check_ins WHERE user_id = ?
+    """, (user_id,)).fetchone()
+
+
+def store_check_in(db, user_id: int, last_check_in: float, next_check_in: float, last_interrupt: float):
+    db.execute("""
+        INSERT OR REPLACE INTO check_ins (user_id, last_check_in, next_check_in, last_interrupt)
+        VALUES (?, ?, ?, ?)
+    """, (user_id, last_check_in, next_check_in, last_interrupt))
+
+
+def store_state(db, user_id: int, events: List[Tuple[int, Optional[str]]], state_json: Optional[str],
+                ts: int, windows: Optional[List[Window]], snapshot: Optional[Tuple[int, str, str]]):
+    """
+    Append message events, replace the settings/activity row (unless state_json is None) and record
+    an activity sample (unless windows is None). With a snapshot (history offset, pinned json,
+    messages json) also write a compacted snapshot, dropping older ones.
+    """
+    c = db.cursor()
+    c.executemany("""
+        INSERT INTO message_events (user_id, idx, message_json)
+        VALUES (?, ?, ?)
+    """, [(user_id, i, message_json) for i, message_json in events])
+    if state_json is not None:
+        c.execute("""
+            INSERT OR REPLACE INTO user_states (user_id, state_json)
+            VALUES (?, ?)
+        """, (user_id, state_json))
+    if windows is not None:
+        record_activity(c, user_id, ts, windows)
+
+    if snapshot is not None:
+        c.execute("""
+            INSERT INTO state_snapshots (user_id, event_id, history_offset, pinned_json, messages_json)
+            SELECT ?, MAX(id), ?, ?, ? FROM message_events WHERE user_id = ?
+        """, (user_id, *snapshot, user_id))
+        c.execute("DELETE FROM state_snapshots WHERE user_id = ? AND id < ?", (user_id, c.lastrowid))
+
+
+class VerdictCache():
+    """
+    Activity GPT already judged on-task ("Great work") for the user's current goal. A check-in whose
+    activity has the same apps and titles as one of these skips the API call. Cleared whenever the
+    user sends a message, since that may change what they're supposed to be doing.
+    """
+    # across all connections, so we can see how many GPT calls are saved
+    stats = {'hits': 0, 'misses': 0}
+    # the line totalling the apps that didn't fit in a report, which could be any apps
+    OTHER_APPS = re.compile(r'^- \d+min on \d+ other apps$', re.MULTILINE)
+
+    def __init__(self, size: int = 64):
+        self.size = size
+        # fingerprints, least recently used first
+        self.on_task: OrderedDict = OrderedDict()
+
+    @classmethod
+    def fingerprint(cls, activity: str) -> Optional[frozenset]:
+        """
+        The apps and titles in an activity summary, without times or counters like unread counts.
+        None if some apps were left out of it.
+        """
+        if cls.OTHER_APPS.search(activity):
+            return None
+        lines = activity.strip().split('\n')[1:]  # first line is the time range
+        return frozenset(
+            re.sub(r'\d+', '#', re.sub(r'^(\s*)- \d+min on ', r'\1', line)).lower()
+            for line in lines
+        )
+
+    def hit(self, activity: str) -> bool:
+        fp = self.fingerprint(activity)
+        hit = fp is not None and fp in self.on_task
+        if hit:
+            self.on_task.move_to_end(fp)
+        self.stats['hits' if hit else 'misses'] += 1
+        return hit
+
+    def add(self, activity: str):
+        fp = self.fingerprint(activity)
+        if fp is None:
+            return
+        self.on_task[fp] = True
+        self.on_task.move_to_end(fp)
+        if len(self.on_task) > self.size:
+            self.on_task.popitem(last=False)
+
+    def clear(self):
+        self.on_task.clear()
+
+
+class VerdictParser():
+    """
+    Parses a check-in reply (reasoning in triple quotes, then the message) while it streams in.
+    The verdict is known as soon as the message starts: on-task if it starts with "Great work",
+    which is all we need from an on-task reply, so the completion can be cancelled right there.
+    """
+    ON_TASK = "Great work"
+    PATTERN = re.compile(r'"""(?P<reasoning>.*?)(?=""")"""\s*(?P<message>.*)', re.DOTALL)
+
+    # across all connections: how many replies were cut short
+    stats = {'cancelled': 0, 'full': 0}
+
+    def __init__(self):
+        self.reasoning: Optional[str] = None
+        self.message: Optional[str] = None
+        self.on_task: Optional[bool] = None
+
+    def feed(self, content: str) -> Optional[bool]:
+        "Parse the content so far, returns on_task once it's certain"
+        match = self.PATTERN.search(content)
+        if match:
+            self.reasoning, self.message = match.group('reasoning'), match.group('message')
+            if not self.ON_TASK.startswith(self.message):
+                self.on_task = self.message.startswith(self.ON_TASK)
+        return self.on_task
+
+    def finish(self):
+        "The reply is complete, whatever it starts with is the verdict"
+        if self.message and self.on_task is None:
+            self.on_task = self.message.startswith(self.ON_TASK)
 
 
 ENCOURAGEMENTS = [
@@ -250,6 +1033,11 @@ ENCOURAGEMENTS = [
 ]
 
 
+# close codes, the client doesn't reconnect after WS_REPLACED
+WS_REPLACED = 4001  # a newer connection for the machine took over
+WS_DUPLICATE = 4002  # another connection for the machine is still active
+
+
 class WebSocketHandler():
     """
     Web socket handler, one per connection. Handles
@@ -257,66 +1045,210 @@ class WebSocketHandler():
     * Querying GPT for triggers and sending messages when required
     """
 
-    def __init__(self, ws, db):
+    def __init__(self, ws, db, scheduler, coordinator, sessions):
         self.ws = ws
         self.db = db
+        self.scheduler = scheduler
+        self.coordinator = coordinator
+        self.sessions = sessions
+        self.connection_id = connection_id()
+        self.claimed = False
         self.app_state: AppState
         self.user_id = None
 
-        # TODO: These should be persisted in the database
+        # persisted in check_ins, loaded on registration
         self.last_check_in = 0
         self.last_interrupt = time.time()
+        # the check_ins row as stored, and whether it (with the state) came from the session cache
+        self.stored_check_in: Optional[Tuple[float, float, float]] = None
+        self.restored = False
+
+        # held while handling a client message or running a check-in, so they don't interleave
+        self.lock = asyncio.Lock()
 
         # for fast-forward: a (time, activity_summary) pair
         self.fastfwd: Optional[Tuple[datetime, str]] = None
 
-        # TODO: Ensure no two clients from the same computer can connect at once.
+        # archived messages build_context always keeps: the system prompt and the user's goal
+        self.pinned: List[Message] = []
+
+        # what's already in the database, so save_state only writes what changed. keys of the
+        # messages from saved_offset on, which is behind the window's offset once it moved
+        self.saved_messages: List[tuple] = []
+        self.saved_offset = 0
+        self.saved_state_json: Optional[str] = None
+        self.events_since_snapshot = 0
+        # (app, title) pairs of the latest activity sample. samples are only recorded when the windows
+        # change, each one's time lasts until the next (see record_activity)
+        self.recorded_windows: Optional[List[Tuple[str, str]]] = None
+        self.recorded_at = 0.0
+
+        # what the client has, so send_state only sends what changed. seq numbers every state/patch sent
+        self.seq = 0
+        self.sent_messages: List[tuple] = []
+        self.sent_offset = 0
+        self.sent_settings: Optional[dict] = None
+
+        self.verdicts = VerdictCache()
+        # only used by one db read at a time, summaries are made under self.lock
+        self.titles = TitleClusters()
 
 
     async def run(self):
+        # uvicorn negotiates permessage-deflate (--ws-per-message-deflate, on by default) with clients that offer it
+        compression = 'deflate' if 'permessage-deflate' in self.ws.headers.get('sec-websocket-extensions', '') else 'none'
         await self.ws.accept()
-        while True:
-            try:
-                msg = await self.receive(timeout=10)
-            except WebSocketDisconnect:
-                print(f'client {self.user_id} disconnected')
-                return
-
-            if msg and msg['type'] == 'state':
-                print('got state from client')
+        CONNECTIONS.inc(1, compression)
+        try:
+            while True:
                 try:
-                    self.app_state = AppState.model_validate(msg['data'])
-                except ValidationError as e:
-                    print(e)
-                    await self.ws.close()
+                    msg = await self.receive()
+                except WebSocketDisconnect:
+                    log.info('client %s disconnected', self.user_id)
                     return
 
-                # treat the first state message as registration
-                if self.user_id is None:
-                    self.user_id = self.get_user_id(self.app_state)
-                    db_app_state = self.get_app_state(self.user_id)
-                    if db_app_state:
-                        self.app_state = db_app_state
-                        await self.send_state()
-                else:
-                    # not registration, save state to db
-                    self.save_state()
-
-                if not self.app_state.messages:
-                    self.app_state.messages += self.initial_messages()
-                    await self.send_state()
-
-
-                # handle messages
-                if self.app_state.messages and self.app_state.messages[-1].role == 'user':
-                    await self.handle_msg()
-
-
-            self.app_state.settings.check_in_interval = 600
-
-            time_since_check_in = time.time() - self.last_check_in
-            if time_since_check_in > self.app_state.settings.check_in_interval:
-                await self.check_in()
+                async with self.lock:
+                    if self.user_id is not None and not self.claimed:
+                        # replaced while waiting for the lock, the state is the newer connection's now
+                        return
+
+                    if msg and msg['type'] == 'resync' and self.user_id is not None:
+                        await self.send_state(full=True)
+
+                    if msg and msg['type'] == 'history' and self.user_id is not None:
+                        await self.send_history(msg.get('data') or {})
+
+                    # the client sends its windows when they change, and otherwise just heartbeats
+                    if msg and msg['type'] == 'activity' and self.user_id is not None:
+                        try:
+                            self.app_state.activity = Activity.model_validate(msg['data'])
+                        except ValidationError as e:
+                            log.warning('invalid activity from client %s: %s', self.user_id, e)
+                            await self.ws.close()
+                            return
+                        await self.save_activity()
+
+                    # the windows are still the same: extend their sample
+                    if msg and msg['type'] == 'heartbeat' and self.user_id is not None:
+                        await self.save_activity()
+
+                    if msg and msg['type'] == 'state':
+                        log.debug('got state from client %s', self.user_id)
+                        try:
+                            state = AppState.model_validate(msg['data'])
+                        except ValidationError as e:
+                            log.warning('invalid state from client %s: %s', self.user_id, e)
+                            await self.ws.close()
+                            return
+                        # if the client hadn't applied everything we sent it, our patches were built on a
+                        # state it doesn't have, so it needs the full state
+                        resync = state.protocol_version >= PATCH_PROTOCOL and msg.get('seq') != self.seq
+                        if resync and self.user_id is not None:
+                            # and its messages are older than ours, e.g. it synced in the middle of a reply
+                            self.merge_stale_state(state)
+                        else:
+                            if self.user_id is not None:
+                                self.align_window(state, msg['data'])
+                            self.app_state = state
+                        # the client now has what it sent us
+                        self.mark_sent()
+
+                        # treat the first state message as registration
+                        registering = self.user_id is None
+                        if registering:
+                            # one connection per machine, whichever worker it's in
+                            if not await self.coordinator.claim(self.app_state.machine_id, self.connection_id, self.replaced):
+                                log.info('rejecting duplicate connection for %s', self.app_state.machine_id)
+                                await self.ws.close(code=WS_DUPLICATE)
+                                return
+                            self.claimed = True
+                            self.user_id = await self.get_user_id(self.app_state)
+                            db_app_state = await self.get_app_state(self.user_id)
+                            if db_app_state:
+                                # keep the client's protocol and windows, not the ones it had when the state was stored
+                                db_app_state.protocol_version = self.app_state.protocol_version
+                                db_app_state.activity = self.app_state.activity
+                                self.app_state = db_app_state
+                                resync = True
+                            await self.save_activity()
+                        else:
+                            # not registration, save state to db
+                            await self.save_state()
+
+                        self.app_state.settings.check_in_interval = CHECK_IN_INTERVAL
+                        if registering:
+                            await self.load_check_ins()
+
+                        if resync:
+                            await self.send_state(full=True)
+
+                        if not self.app_state.messages:
+                            self.app_state.messages += self.initial_messages()
+                            await self.send_state()
+
+                        # handle messages
+                        if self.app_state.messages and self.app_state.messages[-1].role == 'user':
+                            await self.handle_msg()
+        except WebSocketDisconnect:
+            # the client left while we were sending, e.g. in the middle of a streamed reply
+            log.info('client %s disconnected', self.user_id)
+        finally:
+            # check-ins are scheduled per user, a newer connection for the same user may own it now
+            self.scheduler.cancel(self.user_id, self.scheduled_check_in)
+            CONNECTIONS.dec(1, compression)
+            if self.claimed:
+                # for the client's next connection, unless a check-in is still using the state
+                if not self.lock.locked():
+                    async with self.lock:
+                        await self.save_state()
+                        self.cache_session()
+                # the client's gone, its windows stop counting here
+                if self.user_id is not None:
+                    await self.db.enqueue(record_activity, self.user_id, int(time.time()), [])
+                self.claimed = False
+                await self.coordinator.release(self.app_state.machine_id, self.connection_id)
+
+
+    async def replaced(self):
+        "Another connection took over this machine, maybe in another worker. Leave it to that one."
+        log.info('client %s replaced by a newer connection', self.user_id)
+        self.claimed = False
+        self.scheduler.cancel(self.user_id, self.scheduled_check_in)
+        # the newer connection is usually the same client reconnecting, to this worker if it's the
+        # previous owner. not saved first: if it's in another worker it has loaded the state already
+        if not self.lock.locked():
+            self.cache_session()
+        try:
+            await self.ws.close(code=WS_REPLACED)
+        except (RuntimeError, WebSocketDisconnect):
+            pass  # already closed, or the client left
+
+
+    async def load_check_ins(self):
+        "Restore check-in times from the database (or the session cache) and schedule the next check-in"
+        row = self.stored_check_in if self.restored else await self.db.read(load_check_in, self.user_id)
+        self.stored_check_in = row
+        next_check_in = None
+        if row:
+            self.last_check_in, next_check_in, self.last_interrupt = row
+        if next_check_in is None or next_check_in < time.time():
+            # new, or overdue because the server was down: spread users over the interval, not all at once
+            next_check_in = time.time() + stagger(self.user_id, self.app_state.settings.check_in_interval)
+        self.scheduler.schedule(self.user_id, next_check_in, self.scheduled_check_in)
+
+
+    async def scheduled_check_in(self):
+        # taken over by another worker since the last heartbeat, it has the timer now
+        if not await self.coordinator.owns(self.app_state.machine_id, self.connection_id):
+            return
+        async with self.lock:
+            # the connection may have closed while we waited
+            if self.claimed:
+                try:
+                    await self.check_in()
+                except WebSocketDisconnect:
+                    # the client left (or was replaced) in the middle of it
+                    log.info('client %s disconnected during a check-in', self.user_id)
 
 
     def initial_messages(self):
@@ -329,19 +1261,20 @@ class WebSocketHandler():
 
     async def get_activity_summary(self, start: datetime, end: datetime) -> str:
         if self.fastfwd and start <= self.fastfwd[0] <= end:
-            print(f'fast forwarding: fastfwd at {self.fastfwd[1]}')
+            log.debug('fast forwarding: fastfwd at %s', self.fastfwd[1])
             return self.fastfwd[1]
 
         assert self.user_id is not None, f'no user id for {self.app_state}'
-        return get_activity_summary_from_db(self.user_id, self.db, start, end)
+        app_time, title_time = await self.db.read(get_activity_times, self.user_id, start, end, self.titles.label)
+        return get_activity_summary_from_times(app_time, title_time, start, end)
 
 
-    async def trigger_messages(self) -> Optional[List[Message]]:
+    async def trigger_messages(self, priority: int = BACKGROUND) -> Optional[List[Message]]:
         """
         Returns [activity_msg, trigger_msg] if we decide to trigger/interrupt the user.
         """
         if self.user_id is None:
-            print("Not registered yet, can't trigger")
+            log.warning("not registered yet, can't trigger")
             return None
 
         last_n_seconds = self.app_state.settings.check_in_interval
@@ -354,39 +1287,73 @@ class WebSocketHandler():
         activity_msg = Message(role='user', content=CHECK_IN_PROMPT.format(activity=activity))
         await self.debug(f"Trigger msg:\n{activity_msg.content}")
 
-        resp = await openai.post(
-            "/v1/chat/completions",
-            json={
-                "model": "gpt-4",
-                "messages": self.dump_filtered_messages() + [activity_msg.openai_dump()],
-                # "functions": [],
-                "temperature": 0,
-            }
-        )
-        resp.raise_for_status()
-        resp_data = resp.json()
-        message = resp_data['choices'][0]['message']
-        pattern = r'"""(?P<reasoning>.*?)(?=""")"""\s*(?P<message>.+)'
-        match = re.search(pattern, message['content'], re.DOTALL)
-        # TODO: Figure out why I'm getting no reasoning in some cases.
+        if self.verdicts.hit(activity):
+            await self.debug(f"Activity already judged on-task, skipping GPT. Verdict cache: {VerdictCache.stats}")
+            reasoning, reply = "Same activity as a previous on-task check-in", "Great work!"
+        else:
+            verdict = await self.classify(activity_msg, priority)
+            if verdict.on_task is None:
+                return None
+            reasoning, reply = verdict.reasoning, verdict.message
 
-        if match:
-            trigger_msg = Message(role='assistant', content=match.group("message"))
-            trigger = not match.group('message').startswith("Great work")
-            # also trigger every 30 minutes the user remains focused / no interrupting is necessary
-            trigger_encourage = time.time() - self.last_interrupt > 60*30
-            await self.debug(f"Reasoning: {match.group('reasoning')}. Trigger: {trigger} Encourage: {trigger_encourage}")
+        trigger_msg = Message(role='assistant', content=reply)
+        trigger = not reply.startswith("Great work")
+        if not trigger:
+            self.verdicts.add(activity)
+        # also trigger every 30 minutes the user remains focused / no interrupting is necessary
+        trigger_encourage = time.time() - self.last_interrupt > 60*30
+        await self.debug(f"Reasoning: {reasoning}. Trigger: {trigger} Encourage: {trigger_encourage}")
 
 
-            if trigger_encourage:
-                trigger_msg = Message(role='assistant', content=random.choice(ENCOURAGEMENTS))
+        if trigger_encourage:
+            trigger_msg = Message(role='assistant', content=random.choice(ENCOURAGEMENTS))
+
+        if trigger or trigger_encourage:
+            self.last_interrupt = time.time()
+            return [activity_msg, trigger_msg]
+        return None
 
-            if trigger or trigger_encourage:
-                self.last_interrupt = time.time()
-                return [activity_msg, trigger_msg]
-        else:
-            await self.debug(f"Trigger message didn't match pattern:\n{message['content']}")
-            return None
+
+    async def classify(self, activity_msg: Message, priority: int = BACKGROUND) -> VerdictParser:
+        """
+        Stream GPT's verdict on an activity report, hanging up as soon as it's on-task: the rest of
+        the reply would just be "!" and we don't want to wait (or pay) for it.
+        """
+        verdict = VerdictParser()
+        start = time.perf_counter()
+        content, decided, cancelled = '', None, False
+        slot = {}
+        if priority == BACKGROUND:
+            # stale once the next check-in is due, that one judges newer activity
+            slot = {'deadline': self.last_check_in + self.app_state.settings.check_in_interval,
+                    'key': ('check_in', self.user_id)}
+        stream = stream_completion({
+            "model": "gpt-4",
+            "messages": self.dump_filtered_messages([activity_msg]),
+            # "functions": [],
+            "temperature": 0,
+        }, priority, **slot)
+        # leaving the loop early closes the response, which cancels the completion
+        async with aclosing(stream):
+            async for message in stream:
+                content = message.content or ''
+                verdict.feed(content)
+                if decided is None and verdict.on_task is not None:
+                    decided = time.perf_counter() - start
+                if verdict.on_task:
+                    cancelled = True
+                    break
+        verdict.finish()
+
+        if verdict.on_task is None:
+            # TODO: Figure out why I'm getting no reasoning in some cases.
+            await self.debug(f"Trigger message didn't match pattern:\n{content}")
+            return verdict
+        decided = decided or time.perf_counter() - start
+        CHECK_IN_DECISION_SECONDS.observe(decided)
+        VerdictParser.stats['cancelled' if cancelled else 'full'] += 1
+        await self.debug(f"Verdict after {decided:.2f}s, cancelled: {cancelled}")
+        return verdict
 
 
     # TODO: Use or remove
@@ -408,29 +1375,44 @@ class WebSocketHandler():
                 await self.respond_to_msg()
                 break
         else:
-            print("No triggers defined yet.")
+            log.debug("no triggers defined yet")
+
 
+    async def check_in(self, priority: int = BACKGROUND):
+        "Scheduled check-ins are background requests, ones the user asked for (/checkin) interactive"
+        with CHECK_IN_SECONDS.time():
+            await self._check_in(priority)
 
-    async def check_in(self):
+    async def _check_in(self, priority: int):
         self.last_check_in = time.time()
-        messages = await self.trigger_messages()
+        next_check_in = self.last_check_in + self.app_state.settings.check_in_interval
+        self.scheduler.schedule(self.user_id, next_check_in, self.scheduled_check_in)
+
+        try:
+            messages = await self.trigger_messages(priority)
+        except RequestDropped as e:
+            log.info('client %s: check-in dropped while waiting for GPT (%s)', self.user_id, e)
+            messages = None
+        self.stored_check_in = (self.last_check_in, next_check_in, self.last_interrupt)
+        await self.db.enqueue(store_check_in, self.user_id, *self.stored_check_in)
         if messages:
             assert messages[-1].content, f"Empty trigger response msg: {messages[-1]}"
             await self.notify(title="Ana", body=messages[-1].content)
             await self.speak(messages[-1].content)
             self.app_state.messages += messages
             await self.send_state()
-            self.save_state()
+            await self.save_state()
 
     async def handle_msg(self):
         msg = self.app_state.messages[-1].content
-        print(f'handling {msg}')
+        log.debug('client %s: handling %r', self.user_id, msg)
         # TODO: Document msgs automatically for the user
         cmds = ['/clear', '/checkin', '/activity', '/fastfwd', '/debug']
         if msg and any(msg.startswith(cmd) for cmd in cmds):
             self.app_state.messages.pop()
 
             if msg.startswith('/clear'):
+                self.verdicts.clear()
                 args = msg.split(' ')
                 try:
                     self.app_state.messages = self.app_state.messages[:-int(args[1])]
@@ -438,21 +1420,26 @@ class WebSocketHandler():
                     self.app_state.messages = []
 
                 if len(self.app_state.messages) < 2:
+                    # start over, archive included
                     self.app_state.messages = self.initial_messages()
+                    self.app_state.history_offset = 0
+                    self.pinned = []
 
-                self.save_state()
+                await self.save_state()
             elif msg == '/checkin':
-                await self.check_in()
+                await self.check_in(INTERACTIVE)
             elif msg == '/activity':
                 await self.debug(self.get_activity_text())
             elif msg == '/fastfwd':
                 await self.fast_forward()
-                await self.check_in()
+                await self.check_in(INTERACTIVE)
             elif msg == '/debug':
                 self.app_state.settings.debug = True
 
             await self.send_state()
         else:
+            # the user may have changed what they're doing
+            self.verdicts.clear()
             await self.respond_to_msg()
 
 
@@ -487,9 +1474,9 @@ class WebSocketHandler():
         return prefix + activity
 
 
-    def dump_filtered_messages(self, roles=('user', 'assistant', 'function', 'system')):
-        "Dump messages for the OpenAI API"
-        return [m.openai_dump() for m in self.app_state.messages if m.role in roles]
+    def dump_filtered_messages(self, extra: List[Message] = []):
+        "Dump messages for the OpenAI API, within the context token budget"
+        return build_context(self.pinned + self.app_state.messages + extra)
 
 
     async def respond_to_msg(self):
@@ -497,7 +1484,10 @@ class WebSocketHandler():
 
         # prepend system prompt if necessary
         sys_prompt = SYSTEM_PROMPT.format(checkin=self.app_state.settings.check_in_interval//60)
-        if self.app_state.messages[0].role == 'system':
+        archived_system = next((m for m in self.pinned if m.role == 'system'), None)
+        if archived_system:
+            archived_system.content = sys_prompt
+        elif self.app_state.messages[0].role == 'system':
             self.app_state.messages[0].content = sys_prompt
         else:
             self.app_state.messages.insert(0, Message(role='system', content=sys_prompt))
@@ -515,90 +1505,376 @@ class WebSocketHandler():
         if message and message.content:
             await self.notify(title="Ana", body=message.content)
 
-        self.save_state()
+        await self.save_state()
 
     async def speak(self, text: str):
         if self.app_state.settings.tts:
-            print(f"Sending speak: {text}")
-            await self.ws.send_json({"type": "utterance", "data": {"text": text}})
+            log.debug('client %s: sending speak %r', self.user_id, text)
+            await self.send_json({"type": "utterance", "data": {"text": text}})
         else:
-            print(f"Skipping speak: {text} -- tts=False")
+            log.debug('client %s: skipping speak, tts=False', self.user_id)
 
 
     async def debug(self, msg: str):
-        print('DEBUG', msg)
+        log.debug('client %s: %s', self.user_id, msg)
         self.app_state.messages.append(Message(role='debug', content=msg))
         await self.send_state()
 
-    # TODO: Move to aiosqlite3
-    def get_app_state(self, user_id: int) -> Optional[AppState]:
-        "Get most recent app state from the database"
-        with self.db:
-            c = self.db.cursor()
-            rows = c.execute("""
-                SELECT state_json FROM app_states
-                WHERE user_id = ?
-                ORDER BY created_at DESC
-                LIMIT 1
-            """, (user_id,)).fetchone()
-            if rows:
-                try:
-                    return AppState.model_validate_json(rows[0])
-                except ValidationError as e:
-                    print(f"DB appState for {user_id} is invalid: {e}" )
-                    return None
-
-
-    def get_user_id(self, s: AppState) -> int:
-        "get user_id from machine_id from the database"
-        with self.db:
-            c = self.db.cursor()
-            rows = c.execute("SELECT id FROM users WHERE machine_id = ?", (s.machine_id,)).fetchone()
-            if rows is None:
-                c.execute("INSERT INTO users (machine_id, username) VALUES (?, ?)", (s.machine_id, s.username))
-                user_id = c.lastrowid
-            else:
-                user_id = rows[0]
+    async def get_app_state(self, user_id: int) -> Optional[AppState]:
+        "Get most recent app state, cached if this connection's machine was last connected here, else from the database"
+        machine_id = self.app_state.machine_id
+        session = self.sessions.take(machine_id, self.coordinator.previous_owner(machine_id))
+        if session is not None:
+            app_state, self.pinned, self.saved_state_json, self.events_since_snapshot, self.stored_check_in = session
+            self.restored = True
+        else:
+            # a save from a previous connection may still be queued
+            await self.db.flush()
+            loaded, shared = await self.sessions.load(('state', user_id), lambda: self.db.read(load_app_state, user_id))
+            if loaded is None:
+                return None
+            app_state, pinned, self.saved_state_json, self.events_since_snapshot = loaded
+            if shared:
+                # another connection for the machine loaded it at the same time, each needs its own
+                app_state, pinned = app_state.model_copy(deep=True), [m.model_copy(deep=True) for m in pinned]
+            self.pinned = pinned
+        self.saved_messages = [m.key() for m in app_state.messages]
+        self.saved_offset = app_state.history_offset
+        return app_state
+
+
+    def cache_session(self):
+        "Cache the state for when the client reconnects, if it's all saved (so the same as loading it)"
+        if self.user_id is None or self.saved_window() != [m.key() for m in self.app_state.messages]:
+            return
+        self.sessions.put(self.app_state.machine_id, self.connection_id, (
+            self.app_state, self.pinned, self.saved_state_json, self.events_since_snapshot, self.stored_check_in,
+        ))
+
+
+    async def get_user_id(self, s: AppState) -> int:
+        "get user_id from machine_id, from the session cache or the database"
+        user_id = self.sessions.user_id(s.machine_id)
+        if user_id is not None:
+            return user_id
 
-            assert user_id is not None and isinstance(user_id, int), f"user_id: {user_id}"
+        async def load():
+            user_id = await self.db.read(load_user_id, s.machine_id)
+            if user_id is None:
+                user_id = await self.db.write(load_user_id, s.machine_id, s.username)
             return user_id
+        user_id, _ = await self.sessions.load(('user_id', s.machine_id), load)
+
+        assert user_id is not None and isinstance(user_id, int), f"user_id: {user_id}"
+        self.sessions.put_user_id(s.machine_id, user_id)
+        return user_id
+
+
+    async def send_state(self, full=False):
+        "Send state to the client, as a patch against what it already has when it supports that"
+        self.archive_messages()
+        protocol, offset = self.app_state.protocol_version, self.app_state.history_offset
+        # a window that moved is a patch (dropping the oldest messages) only for clients that know about windows
+        moved = offset != self.sent_offset and not (protocol >= HISTORY_PROTOCOL and offset > self.sent_offset)
+        if full or moved or self.sent_settings is None or protocol < PATCH_PROTOCOL:
+            self.seq += 1
+            with SERIALIZATION_SECONDS.time('state'):
+                text = f'{{"type":"state","seq":{self.seq},"data":{self.app_state.dump_json()}}}'
+            await self.send_text(text, 'state')
+        else:
+            with SERIALIZATION_SECONDS.time('patch'):
+                ops = self.state_patch()
+                if not ops:
+                    return
+                text = f'{{"type":"patch","data":{{"seq":{self.seq + 1},"ops":{json_list(ops)}}}}}'
+            self.seq += 1
+            await self.send_text(text, 'patch')
+        self.mark_sent()
 
 
-    async def send_state(self):
-        # print('sending state to client')
-        await self.ws.send_json({"type": "state", "data": self.app_state.model_dump(by_alias=True)})
+    def state_patch(self) -> List[str]:
+        """
+        Ops (serialized) turning the client's state into ours, applied in order:
+        * truncate: keep the first `length` messages
+        * content: message `index` content becomes content[:offset] + text (offset in unicode code points)
+        * replace: message `index` becomes `message`
+        * append: append `message`
+        * settings: settings become `settings`
+        * drop: remove the first `count` messages, history offset grows by `count`
+        """
+        ops = []
+        messages, sent = self.app_state.messages, self.sent_messages
+        dropped = self.app_state.history_offset - self.sent_offset
+        if dropped:
+            ops.append(json.dumps({"op": "drop", "count": dropped}))
+            sent = sent[dropped:]
+        if len(sent) > len(messages):
+            ops.append(json.dumps({"op": "truncate", "length": len(messages)}))
+
+        for i in range(min(len(messages), len(sent))):
+            m = messages[i]
+            key = m.key()
+            if key == sent[i]:
+                continue
+            role, content, function_call, t = sent[i]
+            if (role, function_call, t) == (m.role, m.function_call, m.time) and \
+                    content is not None and m.content is not None and m.content.startswith(content):
+                ops.append(json.dumps({"op": "content", "index": i, "offset": len(content), "text": m.content[len(content):]}))
+            else:
+                ops.append(f'{{"op":"replace","index":{i},"message":{m.dump_json()}}}')
+
+        for m in messages[len(sent):]:
+            ops.append(f'{{"op":"append","message":{m.dump_json()}}}')
+
+        settings = self.app_state.settings.model_dump(by_alias=True)
+        if settings != self.sent_settings:
+            ops.append(json.dumps({"op": "settings", "settings": settings}))
+        return ops
 
 
-    def save_state(self):
-        "Save state to the database"
+    def mark_sent(self):
+        "Record the current state as what the client has"
+        self.sent_messages = [m.key() for m in self.app_state.messages]
+        self.sent_offset = self.app_state.history_offset
+        self.sent_settings = self.app_state.settings.model_dump(by_alias=True)
+
+
+    async def save_state(self):
+        "Save state to the database, only appending message events for what changed since the last save"
+        if not self.claimed:
+            # replaced, the state belongs to the newer connection (maybe in another worker) now
+            log.debug('client %s: not saving state, replaced', self.user_id)
+            return
         # FIXME: client side timestamps inserted into created_at
-        print('saving state to db')
-        with self.db:
-            c = self.db.cursor()
-            c.execute("""
-                INSERT INTO app_states (user_id, state_json)
-                VALUES (?, ?)
-            """, (self.user_id, self.app_state.model_dump_json(by_alias=True)))
-            self.db.commit()
+        log.debug('client %s: saving state', self.user_id)
+        messages, offset = self.app_state.messages, self.app_state.history_offset
+        with SERIALIZATION_SECONDS.time('save'):
+            keys = [m.key() for m in messages]
+
+            # length of the prefix that's already stored, anything after it is rewritten
+            saved = self.saved_window()
+            n = 0
+            while n < min(len(keys), len(saved)) and keys[n] == saved[n]:
+                n += 1
+            # events are indexed in the whole conversation
+            events = [(offset + i, messages[i].dump_json()) for i in range(n, len(messages))]
+            if not events and n < len(saved):
+                events = [(offset + n, None)]
+
+            state_json = self.app_state.model_dump_json(by_alias=True, exclude={'messages', 'history_offset'})
+
+            self.events_since_snapshot += len(events)
+            snapshot = None
+            # a conversation started over below the snapshot's window (/clear) has events the
+            # snapshot can't be replayed with, it needs a new one
+            if self.events_since_snapshot >= SNAPSHOT_EVERY or offset < self.saved_offset:
+                snapshot = (offset, json_list(m.dump_json() for m in self.pinned), json_list(m.dump_json() for m in messages))
+                self.events_since_snapshot = 0
+
+        # update what's saved before awaiting, so a concurrent save doesn't write the same events
+        changed_state_json = state_json if state_json != self.saved_state_json else None
+        self.saved_messages = keys
+        self.saved_offset = offset
+        self.saved_state_json = state_json
+        await self.db.enqueue(
+            store_state, self.user_id, events, changed_state_json,
+            int(time.time()), self.changed_windows(), snapshot,
+        )
 
 
-    async def receive(self, timeout):
+    def saved_window(self) -> List[tuple]:
+        "Keys of the saved messages from the window's offset on. Nothing's saved if the conversation restarted below it."
+        skip = self.app_state.history_offset - self.saved_offset
+        return self.saved_messages[skip:] if skip >= 0 else []
+
+
+    def archive_messages(self):
+        """
+        Once the window is a quarter over MESSAGE_WINDOW, drop its oldest saved messages (they stay in
+        the database for history requests), keeping the system prompt and goal for the GPT context.
+        """
+        messages = self.app_state.messages
+        excess = len(messages) - MESSAGE_WINDOW
+        if excess < MESSAGE_WINDOW // 4:
+            return
+        saved, n = self.saved_window(), 0
+        while n < min(excess, len(saved)) and messages[n].key() == saved[n]:
+            n += 1
+        if n == 0:
+            return
+
+        context = self.pinned + messages[:n]
+        system = next((m for m in context if m.role == 'system'), None)
+        goal = next((m for m in context if m.role == 'user' and not m.is_activity_report()), None)
+        self.pinned = [m for m in (system, goal) if m is not None]
+        self.app_state.messages = messages[n:]
+        self.app_state.history_offset += n
+        log.debug('client %s: archived %d messages, window starts at %d', self.user_id, n, self.app_state.history_offset)
+
+
+    def merge_stale_state(self, state: AppState):
+        """
+        Take the settings and windows of a state the client sent before it had everything we sent it,
+        but keep our messages, which are newer. Only the user's own new messages at its end are added.
+        """
+        ours = {m.key() for m in self.app_state.messages}
+        typed = []
+        for m in reversed(state.messages):
+            if m.role != 'user' or m.key() in ours:
+                break
+            typed.insert(0, m)
+        self.app_state.settings = state.settings
+        self.app_state.activity = state.activity
+        self.app_state.messages += typed
+
+
+    def align_window(self, state: AppState, data: dict):
+        """
+        Line up the messages of a state the client sent with our window. It may not have dropped the
+        messages we archived yet, older clients don't send historyOffset at all.
+        """
+        offset = self.app_state.history_offset
+        client_offset = state.history_offset if 'historyOffset' in data else offset
+        if client_offset < offset:
+            state.messages = state.messages[offset - client_offset:]
+        elif client_offset > offset:
+            # it can't have more archived than we do, keep ours in front
+            state.messages = self.app_state.messages[:client_offset - offset] + state.messages
+        state.history_offset = offset
+
+
+    async def send_history(self, data: dict):
+        "Answer a client's history request: up to `limit` archived messages before index `before`"
+        offset = self.app_state.history_offset
+        try:
+            before = min(int(data.get('before', offset)), offset)
+            limit = min(max(int(data.get('limit', 50)), 1), HISTORY_PAGE)
+        except (TypeError, ValueError):
+            log.warning('invalid history request from client %s: %r', self.user_id, data)
+            return
+        start = max(before - limit, 0)
+        # what was just archived may still be queued
+        await self.db.flush()
+        messages = await self.db.read(load_message_range, self.user_id, start, before) if before > 0 else []
+        await self.send_text(f'{{"type":"history","data":{{"offset":{start},"messages":{json_list(messages)}}}}}', 'history')
+
+
+    def changed_windows(self) -> Optional[List[Window]]:
+        """
+        The visible windows if they changed since the last recorded sample, or it's a heartbeat
+        interval old (so it doesn't run out while the client is still there), else None
+        """
+        windows = self.app_state.activity.visible_windows
+        key = sorted((w['kCGWindowOwnerName'], w['kCGWindowName']) for w in windows)
+        now = time.time()
+        if key == self.recorded_windows and now - self.recorded_at < HEARTBEAT_INTERVAL:
+            return None
+        self.recorded_windows = key
+        self.recorded_at = now
+        return windows
+
+
+    async def save_activity(self):
+        "Record an activity sample if the windows changed, or the last one is a heartbeat interval old"
+        windows = self.changed_windows()
+        if windows is not None:
+            await self.db.enqueue(record_activity, self.user_id, int(time.time()), windows)
+
+
+    async def receive(self, timeout=None):
         try:
             text = await asyncio.wait_for(self.ws.receive_text(), timeout=timeout)
-            return json.loads(text)
+            msg = json.loads(text)
+            type = msg.get('type') if msg.get('type') in CLIENT_MESSAGE_TYPES else 'other'
+            WS_MESSAGE_CHARS.observe(len(text), 'in', type)
+            return msg
         except asyncio.TimeoutError:
             return None
 
 
+    async def send_text(self, text: str, type: str):
+        if self.user_id is not None and not self.claimed:
+            # replaced, which closes the ws: stop what we're sending, as if the client left
+            raise WebSocketDisconnect(WS_REPLACED)
+        WS_MESSAGE_CHARS.observe(len(text), 'out', type)
+        try:
+            await self.ws.send_text(text)
+        except RuntimeError as e:
+            # starlette raises this once the ws is closed
+            raise WebSocketDisconnect() from e
+
+
+    async def send_json(self, msg: dict):
+        await self.send_text(json.dumps(msg), msg['type'])
+
+
     async def notify(self, title: str, body: str):
         "Send a notification to the user's machine"
-        print(f"Sending notification: {title} - {body}")
-        await self.ws.send_json({"type": "notification", "data": {"title": title, "body": body}})
+        log.debug('client %s: sending notification %r', self.user_id, body)
+        await self.send_json({"type": "notification", "data": {"title": title, "body": body}})
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/export/activity")
+async def export_activity(machine_id: str, start: Optional[datetime] = None, end: Optional[datetime] = None, format: str = 'ndjson'):
+    """
+    Stream a machine's activity samples between start and end (ISO 8601, in the user's timezone
+    unless they have an offset, default the last day) as NDJSON, one sample per line, or CSV, one
+    window per row.
+    """
+    if format not in ('ndjson', 'csv'):
+        raise HTTPException(400, 'format must be ndjson or csv')
+    user = await app.state.db.read(load_user_timezone, machine_id)
+    if user is None:
+        raise HTTPException(404, 'unknown machine')
+    user_id, timezone = user
+    try:
+        tz = pytz.timezone(timezone)
+    except pytz.UnknownTimeZoneError:
+        tz = pytz.utc
+
+    end = end or datetime.now(tz=tz)
+    start = start or end - timedelta(days=1)
+    start, end = [dt if dt.tzinfo else tz.localize(dt) for dt in (start, end)]
+    if start >= end:
+        raise HTTPException(400, 'start must be before end')
+    start_ts, end_ts = int(start.timestamp()), int(end.timestamp())
+
+    def ndjson(ts, seconds, windows):
+        return json.dumps({
+            'ts': ts, 'time': datetime.fromtimestamp(ts, tz).isoformat(), 'seconds': seconds,
+            'windows': [{'app': name, 'title': title} for name, title in windows],
+        }) + '\n'
+
+    def csv_rows(ts, seconds, windows):
+        out = io.StringIO()
+        iso = datetime.fromtimestamp(ts, tz).isoformat()
+        csv.writer(out).writerows([(iso, ts, seconds, name, title) for name, title in windows] or [(iso, ts, seconds, '', '')])
+        return out.getvalue()
+
+    async def body():
+        if format == 'csv':
+            yield 'time,ts,seconds,app,title\r\n'
+        encode = ndjson if format == 'ndjson' else csv_rows
+        # closed right away if the client goes away, which closes the export's connection
+        async with aclosing(app.state.db.iterate(query_activity_export, user_id, start_ts, end_ts)) as batches:
+            # a response write per batch of rows, not per sample
+            async for samples in activity_export_samples(batches, start_ts, end_ts):
+                yield ''.join(encode(*sample) for sample in samples)
+
+    media_type = 'application/x-ndjson' if format == 'ndjson' else 'text/csv'
+    return StreamingResponse(body(), media_type=media_type, headers={
+        'Content-Disposition': f'attachment; filename="activity-{start:%Y%m%d}-{end:%Y%m%d}.{format}"',
+    })
 
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    await WebSocketHandler(websocket, app.state.db).run()
+    await WebSocketHandler(websocket, app.state.db, app.state.scheduler, app.state.coordinator, app.state.sessions).run()
 
 
 app.mount("/", StaticFiles(directory="static", html=True))
@@ -0,0 +1,328 @@
+"""
+Shared client for the OpenAI API. One HTTP/2 connection pool with explicit limits, a cap on
+completions in flight (extra ones wait their turn instead of piling onto the pool), and retries
+with jittered exponential backoff on 429s, 5xx and connection errors.
+
+Waiting requests get slots by priority class: interactive ones (a user waiting for a reply) before
+background ones (check-ins), which also leave a few slots free for interactive requests. A waiting
+request can have a deadline and a key; it's dropped once the deadline passes, or when a newer
+request with the same key starts waiting.
+
+Also incremental parsing of streamed completions: server-sent events as the bytes arrive, and
+the deltas of each choice accumulated in lists that are joined only when read.
+"""
+import asyncio
+import heapq
+import itertools
+import json
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+
+import httpx
+
+from metrics import Histogram
+
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# priority classes, lower ones get slots first
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BACKGROUND: 'background'}
+
+QUEUE_WAIT_SECONDS = Histogram(
+    'ana_openai_queue_wait_seconds', 'Requests, from asking for a slot to getting it (or being dropped)', ('priority',))
+RESPONSE_SECONDS = Histogram(
+    'ana_openai_response_seconds', 'Attempts, from sending a request to its response (the headers, for streams)')
+
+
+class RequestDropped(Exception):
+    "A request was dropped while waiting for a slot: past its deadline, or superseded by a newer one with its key"
+
+
+class Waiter():
+    def __init__(self, priority: int, key):
+        self.priority = priority
+        self.key = key
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class OpenAIClient():
+    def __init__(self, api_key: str, base_url: str = "https://api.openai.com", http2: bool = True,
+                 max_connections: int = 20, max_in_flight: int = 16, interactive_reserve: int = 4,
+                 max_retries: int = 3, timeout: float = 100, backoff: float = 0.5, max_backoff: float = 20):
+        self.http = httpx.AsyncClient(
+            base_url=base_url,
+            headers={"Authorization": f"Bearer {api_key}"},
+            http2=http2,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=httpx.Timeout(timeout, connect=10),
+        )
+        self.max_in_flight = max_in_flight
+        # background requests leave this many slots for interactive ones, so a burst of check-ins
+        # doesn't make a user wait for their reply
+        self.background_limit = max(max_in_flight - interactive_reserve, 1)
+        self.background_in_flight = 0
+        # heap of (priority, seq, waiter). dropped or cancelled waiters stay in it until they reach the top
+        self.queue: list = []
+        self.seq = itertools.count()
+        self.waiting: Dict[object, Waiter] = {}  # by key
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.counters = {'requests': 0, 'retries': 0, 'failures': 0, 'in_flight': 0, 'expired': 0, 'superseded': 0}
+
+
+    async def _wait(self, attempt: int, resp: Optional[httpx.Response]):
+        "Sleep before retrying: Retry-After if the server gave one, otherwise jittered exponential backoff"
+        self.counters['retries'] += 1
+        retry_after = resp.headers.get('retry-after') if resp is not None else None
+        try:
+            delay = float(retry_after) if retry_after else None
+        except ValueError:
+            delay = None
+        if delay is None:
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        await asyncio.sleep(min(delay, self.max_backoff))
+
+
+    async def _send(self, request: httpx.Request, stream: bool) -> httpx.Response:
+        "Send with retries, the last response is returned whatever its status"
+        for attempt in range(self.max_retries + 1):
+            start = time.perf_counter()
+            resp = None
+            try:
+                resp = await self.http.send(request, stream=stream)
+            except httpx.TransportError:
+                if attempt == self.max_retries:
+                    self.counters['failures'] += 1
+                    raise
+            else:
+                RESPONSE_SECONDS.observe(time.perf_counter() - start)
+                if resp.status_code not in RETRY_STATUSES or attempt == self.max_retries:
+                    if resp.status_code >= 400:
+                        self.counters['failures'] += 1
+                    return resp
+                await resp.aclose()
+            await self._wait(attempt, resp)
+        raise AssertionError('unreachable')
+
+
+    @asynccontextmanager
+    async def stream(self, url: str, json: dict, priority: int = INTERACTIVE, deadline: Optional[float] = None, key=None):
+        """
+        POST json and stream the response, retrying until it starts. Check the status of what's yielded.
+        Waits for a slot in its priority class, raising RequestDropped if it's still waiting at deadline
+        (unix time) or another request with the same key starts waiting.
+        """
+        async with self._slot(priority, deadline, key):
+            resp = await self._send(self.http.build_request('POST', url, json=json), stream=True)
+            try:
+                yield resp
+            finally:
+                await resp.aclose()
+
+
+    @asynccontextmanager
+    async def _slot(self, priority: int, deadline: Optional[float], key):
+        start = time.perf_counter()
+        try:
+            await self._acquire(priority, deadline, key)
+        finally:
+            QUEUE_WAIT_SECONDS.observe(time.perf_counter() - start, PRIORITY_NAMES[priority])
+        self.counters['requests'] += 1
+        try:
+            yield
+        finally:
+            self._release(priority)
+
+
+    def _can_start(self, priority: int) -> bool:
+        if self.counters['in_flight'] >= self.max_in_flight:
+            return False
+        return priority != BACKGROUND or self.background_in_flight < self.background_limit
+
+
+    def _start(self, priority: int):
+        self.counters['in_flight'] += 1
+        if priority == BACKGROUND:
+            self.background_in_flight += 1
+
+
+    def _release(self, priority: int):
+        self.counters['in_flight'] -= 1
+        if priority == BACKGROUND:
+            self.background_in_flight -= 1
+        self._dispatch()
+
+
+    def _dispatch(self):
+        "Give free slots to the waiters at the top of the queue"
+        while self.queue:
+            priority, _, waiter = self.queue[0]
+            if waiter.future.done():
+                heapq.heappop(self.queue)
+                continue
+            # everything after a background request is background too
+            if not self._can_start(priority):
+                break
+            heapq.heappop(self.queue)
+            self._start(priority)
+            waiter.future.set_result(None)
+
+
+    def _drop(self, waiter: Waiter, reason: str):
+        if not waiter.future.done():
+            self.counters[reason] += 1
+            waiter.future.set_exception(RequestDropped(reason))
+
+
+    async def _acquire(self, priority: int, deadline: Optional[float], key):
+        if key is not None and key in self.waiting:
+            self._drop(self.waiting.pop(key), 'superseded')
+        if deadline is not None and deadline <= time.time():
+            self.counters['expired'] += 1
+            raise RequestDropped('expired')
+        if not self.queue and self._can_start(priority):
+            self._start(priority)
+            return
+
+        waiter = Waiter(priority, key)
+        heapq.heappush(self.queue, (priority, next(self.seq), waiter))
+        if key is not None:
+            self.waiting[key] = waiter
+        expire = None
+        if deadline is not None:
+            expire = asyncio.get_running_loop().call_later(deadline - time.time(), self._drop, waiter, 'expired')
+        self._dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            # cancelled right after getting a slot, give it back
+            if waiter.future.done() and not waiter.future.cancelled() and waiter.future.exception() is None:
+                self._release(priority)
+            raise
+        finally:
+            if expire is not None:
+                expire.cancel()
+            if key is not None and self.waiting.get(key) is waiter:
+                del self.waiting[key]
+
+
+    def queued(self) -> Dict[str, int]:
+        "Requests waiting for a slot, by priority class"
+        counts = {name: 0 for name in PRIORITY_NAMES.values()}
+        for priority, _, waiter in self.queue:
+            if not waiter.future.done():
+                counts[PRIORITY_NAMES[priority]] += 1
+        return counts
+
+
+    async def aclose(self):
+        await self.http.aclose()
+
+
+class SSEParser():
+    "Incremental server-sent events parser, feed it bytes as they arrive to get each event's data"
+
+    def __init__(self):
+        self.buffer = b''  # an incomplete line
+        self.data: List[bytes] = []  # data lines of the event being read
+
+    def feed(self, chunk: bytes) -> List[str]:
+        "Data of the events completed by chunk"
+        lines = (self.buffer + chunk).split(b'\n')
+        self.buffer = lines.pop()
+        events = []
+        for line in lines:
+            if line.endswith(b'\r'):
+                line = line[:-1]
+            if not line:
+                # a blank line ends the event
+                if self.data:
+                    events.append(b'\n'.join(self.data).decode())
+                    self.data = []
+            elif line.startswith(b'data:'):
+                self.data.append(line[6:] if line.startswith(b'data: ') else line[5:])
+            # comments (":...") and other fields (event, id, retry) aren't used by the API
+        return events
+
+
+class ChoiceBuilder():
+    "One choice of a streamed chat completion, content and function call arguments kept as lists of deltas"
+
+    def __init__(self):
+        self.role: Optional[str] = None
+        self.finish_reason: Optional[str] = None
+        self.content_parts: List[str] = []
+        self.function_name_parts: List[str] = []
+        self.arguments_parts: List[str] = []
+        self.has_function_call = False
+        self.changed = False  # since the last read
+
+    def add(self, choice: dict):
+        delta = choice.get('delta') or {}
+        if delta:
+            self.changed = True
+        if delta.get('role'):
+            self.role = delta['role']
+        if delta.get('content'):
+            self.content_parts.append(delta['content'])
+        function_call = delta.get('function_call')
+        if function_call:
+            self.has_function_call = True
+            if function_call.get('name'):
+                self.function_name_parts.append(function_call['name'])
+            if function_call.get('arguments'):
+                self.arguments_parts.append(function_call['arguments'])
+        if choice.get('finish_reason'):
+            self.finish_reason = choice['finish_reason']
+
+    @staticmethod
+    def _join(parts: List[str]) -> str:
+        "Join the deltas, keeping the result as the only part so the next join starts from it"
+        if len(parts) > 1:
+            parts[:] = [''.join(parts)]
+        return parts[0] if parts else ''
+
+    @property
+    def content(self) -> Optional[str]:
+        return self._join(self.content_parts) if self.content_parts else None
+
+    @property
+    def function_call(self) -> Optional[dict]:
+        if not self.has_function_call:
+            return None
+        return {'name': self._join(self.function_name_parts), 'arguments': self._join(self.arguments_parts)}
+
+
+class DeltaAssembler():
+    """
+    Accumulates a streamed chat completion, e.g.
+        for data in parser.feed(chunk):
+            assembler.add(data)
+        assembler.choices[0].content
+    """
+
+    def __init__(self):
+        self.choices: Dict[int, ChoiceBuilder] = {}
+        self.done = False
+
+    def add(self, data: str):
+        "Add one event's data: a JSON chunk, or [DONE] at the end of the stream"
+        if data.strip() == '[DONE]':
+            self.done = True
+            return
+        for choice in json.loads(data).get('choices', []):
+            index = choice.get('index', 0)
+            if index not in self.choices:
+                self.choices[index] = ChoiceBuilder()
+            self.choices[index].add(choice)
+
+    @property
+    def finished(self) -> bool:
+        "[DONE] was received, or every choice has a finish reason"
+        return self.done or bool(self.choices) and all(c.finish_reason for c in self.choices.values())
@@ -0,0 +1,89 @@
+"""
+One process-wide timer for everyone's check-ins, instead of every connection waking up every few
+seconds to see if it's time yet. A heap of (due time, key), the callback for a key is replaced
+when it's scheduled again, so each key (user) has at most one pending check-in.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+import zlib
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+
+log = logging.getLogger(__name__)
+
+
+def stagger(key, interval: float) -> float:
+    "A stable offset in [0, interval) for key, so keys due at the same moment get spread out"
+    return zlib.crc32(str(key).encode()) % 1000 / 1000 * interval
+
+
+class Scheduler():
+    def __init__(self):
+        self.heap: list = []  # (due, seq, key), entries whose seq isn't in self.entries are stale
+        self.entries: Dict[object, Tuple[float, int, Callable[[], Awaitable]]] = {}
+        self.seq = itertools.count()
+        self.wake = asyncio.Event()
+        self.tasks: set = set()
+        self.runner: Optional[asyncio.Task] = None
+
+
+    def schedule(self, key, due: float, callback: Callable[[], Awaitable]):
+        "Run callback() at unix time due, replacing whatever was scheduled for key"
+        seq = next(self.seq)
+        self.entries[key] = (due, seq, callback)
+        heapq.heappush(self.heap, (due, seq, key))
+        self.wake.set()
+
+
+    def cancel(self, key, callback: Optional[Callable[[], Awaitable]] = None):
+        "Cancel key's pending callback, only if it's `callback` when given"
+        entry = self.entries.get(key)
+        if entry and (callback is None or entry[2] == callback):
+            del self.entries[key]
+
+
+    def _dispatch(self, key, callback):
+        async def run():
+            try:
+                await callback()
+            except Exception as e:
+                log.exception('scheduled callback for %s failed: %r', key, e)
+
+        task = asyncio.create_task(run())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+
+    async def run(self):
+        while True:
+            now = time.time()
+            while self.heap and self.heap[0][0] <= now:
+                due, seq, key = heapq.heappop(self.heap)
+                entry = self.entries.get(key)
+                if entry and entry[1] == seq:
+                    del self.entries[key]
+                    self._dispatch(key, entry[2])
+
+            # drop cancelled / rescheduled entries so the heap doesn't grow with reschedules
+            while self.heap and self.entries.get(self.heap[0][2], (0, None))[1] != self.heap[0][1]:
+                heapq.heappop(self.heap)
+
+            self.wake.clear()
+            timeout = self.heap[0][0] - time.time() if self.heap else None
+            try:
+                await asyncio.wait_for(self.wake.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+    def start(self):
+        self.runner = asyncio.create_task(self.run())
+
+
+    def stop(self):
+        if self.runner:
+            self.runner.cancel()
+            self.runner = None
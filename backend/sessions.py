@@ -0,0 +1,99 @@
+"""
+Per-worker cache of what a connection loads when its machine registers: the user id, and for
+`ttl` seconds after a connection closes, its app state. A client reconnecting to the same worker
+(the app retries every second after a network blip or a server restart) then registers without
+reading the database.
+
+A cached state is only used if it's still what the database has: it's cached at release only
+when everything was saved, and only used if the connection that cached it is the machine's
+previous owner in the coordinator, so no connection (in any worker) changed it since.
+
+Loads of the same key running at the same time are done once, the callers share the result.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+
+class SessionCache():
+    def __init__(self, size: int = 10000, ttl: float = 600):
+        self.size = size
+        self.ttl = ttl
+        # machine_id -> user_id, which never changes
+        self.user_ids: OrderedDict = OrderedDict()
+        # machine_id -> (cached at, owner that cached it, session)
+        self.sessions: OrderedDict = OrderedDict()
+        self.loading: Dict[object, asyncio.Task] = {}
+        self.counters = {'hits': 0, 'misses': 0, 'stale': 0, 'expired': 0, 'shared_loads': 0}
+
+
+    def user_id(self, machine_id: str) -> Optional[int]:
+        user_id = self.user_ids.get(machine_id)
+        if user_id is not None:
+            self.user_ids.move_to_end(machine_id)
+        return user_id
+
+
+    def put_user_id(self, machine_id: str, user_id: int):
+        self.user_ids[machine_id] = user_id
+        self.user_ids.move_to_end(machine_id)
+        if len(self.user_ids) > self.size:
+            self.user_ids.popitem(last=False)
+
+
+    def put(self, machine_id: str, owner: str, session):
+        "Cache the session of owner, the connection releasing the machine"
+        self.expire()
+        self.sessions[machine_id] = (time.monotonic(), owner, session)
+        self.sessions.move_to_end(machine_id)
+        if len(self.sessions) > self.size:
+            self.sessions.popitem(last=False)
+
+
+    def take(self, machine_id: str, previous_owner: Optional[str]):
+        """
+        The cached session of machine_id, removed from the cache (the new connection owns it now).
+        None if there's none, it expired, or it was cached by another connection than previous_owner.
+        """
+        entry = self.sessions.pop(machine_id, None)
+        if entry is None:
+            self.counters['misses'] += 1
+            return None
+        cached_at, owner, session = entry
+        if owner != previous_owner:
+            self.counters['stale'] += 1
+            return None
+        if time.monotonic() - cached_at > self.ttl:
+            self.counters['expired'] += 1
+            return None
+        self.counters['hits'] += 1
+        return session
+
+
+    def expire(self):
+        "Drop the sessions past their ttl, oldest first"
+        now = time.monotonic()
+        while self.sessions:
+            machine_id, (cached_at, _, _) = next(iter(self.sessions.items()))
+            if now - cached_at <= self.ttl:
+                break
+            del self.sessions[machine_id]
+            self.counters['expired'] += 1
+
+
+    async def load(self, key, fn: Callable[[], Awaitable]) -> Tuple[object, bool]:
+        """
+        Await fn(), unless a load of key is already running: then wait for that one instead.
+        Returns (result, shared), shared results are the same object for every caller.
+        """
+        task = self.loading.get(key)
+        shared = task is not None
+        if shared:
+            self.counters['shared_loads'] += 1
+        else:
+            task = asyncio.ensure_future(fn())
+            self.loading[key] = task
+            task.add_done_callback(lambda _: self.loading.pop(key) if self.loading.get(key) is task else None)
+        # a caller that's cancelled doesn't cancel the load for the others
+        return await asyncio.shield(task), shared
@@ -0,0 +1,214 @@
+"""
+Async access to the sqlite database. Queries run in worker threads so a slow one never stalls
+the event loop (and every other websocket with it): reads go through a bounded pool of reader
+connections, writes through a single writer connection, which is all sqlite allows anyway.
+
+Writes nobody waits on (state syncs) can be queued with `enqueue`, they're coalesced across all
+connections and flushed in one transaction (one fsync) once the batch is big or old enough.
+
+Results too big to hold in memory (exports) can be streamed with `iterate`.
+"""
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, List, Optional
+
+from metrics import Histogram
+
+
+log = logging.getLogger(__name__)
+
+QUERY_SECONDS = Histogram(
+    'ana_db_query_seconds', 'Time running each database function in its worker thread',
+    ('fn', 'mode'),
+)
+FLUSH_SECONDS = Histogram('ana_db_flush_seconds', 'Time writing each batch of queued writes, waiting for the writer included')
+BATCH_WRITES = Histogram(
+    'ana_db_batch_writes', 'Writes in each flushed batch', buckets=(1, 4, 16, 64, 256, 1024, 4096),
+)
+
+
+PRAGMAS = [
+    # readers don't block the writer (or each other) in WAL mode
+    "PRAGMA journal_mode = WAL",
+    # with WAL this can only lose the last transactions on power loss, never corrupt the db
+    "PRAGMA synchronous = NORMAL",
+    # wait on locks (e.g. a checkpoint) instead of failing with "database is locked"
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",  # 16MB per connection
+]
+
+
+class Storage():
+    """
+    Runs functions taking a sqlite3 connection off the event loop, e.g.
+        user_id = await db.read(get_user_id, machine_id)
+    `write` runs the function in a transaction on the writer connection.
+    `enqueue` queues it for the next batch, call `start` to flush batches in the background.
+    """
+
+    def __init__(self, path: str, readers: int = 4, batch_size: int = 256, flush_interval: float = 0.5):
+        self.path = path
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+        self.readers = ThreadPoolExecutor(readers, thread_name_prefix='db-reader', initializer=self._open)
+        self.writer = ThreadPoolExecutor(1, thread_name_prefix='db-writer', initializer=self._open)
+
+        # write-behind queue of (fn, args)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending: list = []
+        self.wake = asyncio.Event()
+        self.flush_lock = asyncio.Lock()  # so flush() returns only once earlier batches are written too
+        self.flusher: Optional[asyncio.Task] = None
+        self.counters = {
+            'flushes': 0,
+            'flushed_writes': 0,
+            'failed_writes': 0,
+        }
+
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+
+    def _open(self):
+        "Open this worker thread's connection"
+        conn = self._connect()
+        self.local.conn = conn
+        with self.lock:
+            self.connections.append(conn)
+
+
+    def _read(self, fn, args):
+        with QUERY_SECONDS.time(fn.__name__, 'read'):
+            return fn(self.local.conn, *args)
+
+
+    def _write(self, fn, args):
+        conn = self.local.conn
+        with QUERY_SECONDS.time(fn.__name__, 'write'), conn:
+            return fn(conn, *args)
+
+
+    def _write_batch(self, batch) -> int:
+        "Run a batch in one transaction, each write in a savepoint so one failing doesn't lose the rest"
+        conn = self.local.conn
+        failed = 0
+        with conn:
+            conn.execute("BEGIN")
+            for fn, args in batch:
+                conn.execute("SAVEPOINT batch_write")
+                start = time.perf_counter()
+                try:
+                    fn(conn, *args)
+                except Exception as e:
+                    log.warning('batched write %s failed: %r', fn.__name__, e)
+                    conn.execute("ROLLBACK TO batch_write")
+                    failed += 1
+                QUERY_SECONDS.observe(time.perf_counter() - start, fn.__name__, 'batched')
+                conn.execute("RELEASE batch_write")
+        return failed
+
+
+    async def read(self, fn, *args):
+        "Run fn(conn, *args) on a reader connection"
+        return await asyncio.get_running_loop().run_in_executor(self.readers, self._read, fn, args)
+
+
+    async def iterate(self, fn, *args, batch: int = 1000) -> AsyncIterator[List[tuple]]:
+        """
+        Rows of the cursor fn(conn, *args) returns, in lists of up to `batch`. Runs on a connection
+        and thread of its own, so a long export neither holds up the readers nor loads the whole
+        result into memory. (It does keep one read snapshot open until it's done.)
+        """
+        loop = asyncio.get_running_loop()
+        # one thread, so the connection is closed only after the last fetch finished
+        thread = ThreadPoolExecutor(1, thread_name_prefix='db-iterate')
+        conn = await loop.run_in_executor(thread, self._connect)
+        start = time.perf_counter()
+        try:
+            cursor = await loop.run_in_executor(thread, fn, conn, *args)
+            while True:
+                rows = await loop.run_in_executor(thread, cursor.fetchmany, batch)
+                if not rows:
+                    return
+                yield rows
+        finally:
+            QUERY_SECONDS.observe(time.perf_counter() - start, fn.__name__, 'iterate')
+            thread.submit(conn.close)
+            thread.shutdown(wait=False)
+
+
+    async def write(self, fn, *args):
+        "Run fn(conn, *args) in a transaction on the writer connection, committing if it returns"
+        return await asyncio.get_running_loop().run_in_executor(self.writer, self._write, fn, args)
+
+
+    async def enqueue(self, fn, *args):
+        "Queue fn(conn, *args) for the next batched write. Only waits when the queue is far behind."
+        self.pending.append((fn, args))
+        if len(self.pending) >= self.batch_size:
+            self.wake.set()
+        if len(self.pending) >= 10 * self.batch_size:
+            await self.flush()
+
+
+    async def flush(self):
+        "Write everything queued so far in one transaction"
+        async with self.flush_lock:
+            if not self.pending:
+                return
+            batch, self.pending = self.pending, []
+            BATCH_WRITES.observe(len(batch))
+            with FLUSH_SECONDS.time():
+                failed = await asyncio.get_running_loop().run_in_executor(self.writer, self._write_batch, batch)
+
+        self.counters['flushes'] += 1
+        self.counters['flushed_writes'] += len(batch) - failed
+        self.counters['failed_writes'] += failed
+
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                log.exception('flushing writes failed: %r', e)
+
+
+    def start(self):
+        "Start flushing queued writes in the background, every flush_interval or batch_size writes"
+        self.flusher = asyncio.create_task(self._flush_loop())
+
+
+    def stats(self) -> dict:
+        "Write-behind counters, for sizing batch_size / flush_interval"
+        return {**self.counters, 'queue_depth': len(self.pending)}
+
+
+    async def close(self):
+        "Flush queued writes, wait for running queries then close every connection"
+        if self.flusher:
+            self.flusher.cancel()
+            self.flusher = None
+        await self.flush()
+        self.readers.shutdown(wait=True)
+        self.writer.shutdown(wait=True)
+        with self.lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections.clear()
@@ -0,0 +1,74 @@
+"What the app does on the websocket, for the tests"
+import json
+import sqlite3
+
+import main
+
+
+def client_state(messages, offset=0):
+    return {
+        'machineId': 'test-machine', 'username': 'test', 'version': 'test', 'protocolVersion': 3,
+        'historyOffset': offset, 'messages': messages,
+        'settings': {'prompts': [], 'checkInInterval': 600, 'timezone': 'UTC'},
+        'activity': {'visibleWindows': [{'kCGWindowOwnerName': 'Code', 'kCGWindowName': 'main.py'}]},
+    }
+
+
+def apply_patch(state, patch):
+    "What the app does with a patch, see AppState.applying in Sources/App/AppMain.swift"
+    messages = state['messages']
+    for op in patch['ops']:
+        if op['op'] == 'truncate':
+            del messages[op['length']:]
+        elif op['op'] == 'content':
+            m = messages[op['index']]
+            m['content'] = m['content'][:op['offset']] + op['text']
+        elif op['op'] == 'replace':
+            messages[op['index']] = op['message']
+        elif op['op'] == 'append':
+            messages.append(op['message'])
+        elif op['op'] == 'settings':
+            state['settings'] = op['settings']
+        elif op['op'] == 'drop':
+            del messages[:op['count']]
+            state['historyOffset'] += op['count']
+
+
+class App():
+    "A protocol 3 client keeping its state in sync with the server's"
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.ws.send_text(json.dumps({'type': 'state', 'data': client_state([])}))
+        self.state, self.seq = None, None
+        self.receive()
+
+    def receive(self):
+        msg = self.ws.receive_json()
+        if msg['type'] == 'state':
+            self.state, self.seq = msg['data'], msg['seq']
+        elif msg['type'] == 'patch':
+            assert msg['data']['seq'] == self.seq + 1
+            apply_patch(self.state, msg['data'])
+            self.seq = msg['data']['seq']
+        return msg
+
+    def sync(self):
+        "Send our state, with the seq of the last thing we applied"
+        self.ws.send_text(json.dumps({'type': 'state', 'seq': self.seq, 'data': self.state}))
+
+    def say(self, content):
+        "Send a message, returning once the server answered it"
+        self.state['messages'].append({'role': 'user', 'content': content})
+        self.sync()
+        self.receive()
+
+
+def stored_state(db_path):
+    db = sqlite3.connect(db_path)
+    try:
+        user_id, = db.execute("SELECT id FROM users WHERE machine_id = 'test-machine'").fetchone()
+        app_state, pinned, _, _ = main.load_app_state(db, user_id)
+        return app_state, pinned
+    finally:
+        db.close()
@@ -0,0 +1,23 @@
+import os
+import sys
+
+BACKEND = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, BACKEND)
+os.chdir(BACKEND)  # main serves ./static
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+os.environ.setdefault('HOST', 'test')
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    "A fresh database, read after the server shut down (and flushed its writes)"
+    path = str(tmp_path / 'db.sqlite3')
+    monkeypatch.setenv('DB_PATH', path)
+    monkeypatch.setenv('COORDINATION_DB', str(tmp_path / 'coordination.sqlite3'))
+    monkeypatch.setattr(main, 'MESSAGE_WINDOW', 8)
+    monkeypatch.setattr(main, 'SNAPSHOT_EVERY', 5)
+    return path
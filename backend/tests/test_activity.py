@@ -0,0 +1,103 @@
+"""
+Time on windows rebuilt from activity samples, which the app only sends when its windows change
+(and otherwise heartbeats), across the gaps when it's asleep or offline.
+"""
+import asyncio
+import sqlite3
+from datetime import datetime, timezone
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from app_client import App
+
+YOUTUBE = [{'kCGWindowOwnerName': 'YouTube', 'kCGWindowName': 'MrBeast'}]
+CODE = [{'kCGWindowOwnerName': 'Code', 'kCGWindowName': 'main.py'}]
+HOUR = 60 * 60
+T0 = 1_700_000_000 // HOUR * HOUR
+
+
+@pytest.fixture
+def db():
+    db = sqlite3.connect(':memory:')
+    main.setup_db(db)
+    db.execute("INSERT INTO users (machine_id, username) VALUES ('test-machine', 'test')")
+    yield db
+    db.close()
+
+
+def record(db, ts, windows):
+    with db:
+        main.record_activity(db, 1, ts, windows)
+
+
+def connected(db, start, seconds, windows):
+    "A connection on windows for seconds, heartbeating, then closed"
+    for ts in range(start, start + seconds, main.HEARTBEAT_INTERVAL):
+        record(db, ts, windows)
+    record(db, start + seconds, [])
+
+
+def times(db, start, end):
+    return main.get_activity_times(db, 1, datetime.fromtimestamp(start, timezone.utc), datetime.fromtimestamp(end, timezone.utc))
+
+
+def test_disconnect_closes_the_sample(db):
+    connected(db, T0, 5 * 60, YOUTUBE)
+    # still connected at the check-in
+    for ts in range(T0 + 8 * HOUR, T0 + 8 * HOUR + 3 * 60, main.HEARTBEAT_INTERVAL):
+        record(db, ts, CODE)
+    check_in = T0 + 8 * HOUR + 3 * 60
+    assert times(db, check_in - 10 * 60, check_in) == ({'Code': 3}, {'Code': {'main.py': 3}})
+    assert times(db, T0, T0 + HOUR) == ({'YouTube': 5}, {'YouTube': {'MrBeast': 5}})
+
+
+def test_open_sample_runs_out(db):
+    "Gone without closing the connection: the latest sample doesn't last until now"
+    record(db, T0, YOUTUBE)
+    assert times(db, T0 + 8 * HOUR - 10 * 60, T0 + 8 * HOUR) == ({}, {})
+    assert times(db, T0, T0 + HOUR) == ({'YouTube': 2}, {'YouTube': {'MrBeast': 2}})
+
+
+def test_gap_without_disconnect(db):
+    "Gone without closing the connection, back 8 hours later: the gap isn't rolled up"
+    record(db, T0, YOUTUBE)
+    record(db, T0 + 8 * HOUR, CODE)
+    app_time, title_time = times(db, T0 + 8 * HOUR - 10 * 60, T0 + 8 * HOUR + 60)
+    assert 'YouTube' not in app_time and 'YouTube' not in title_time
+    assert times(db, T0, T0 + HOUR) == ({'YouTube': 2}, {'YouTube': {'MrBeast': 2}})
+    # two minute buckets and an hour bucket, not 8 hours of them
+    assert db.execute("SELECT COUNT(*) FROM activity_rollups").fetchone() == (3,)
+
+
+def test_connection_end_is_recorded(db_path):
+    with TestClient(main.app) as client, client.websocket_connect('/ws') as ws:
+        App(ws)
+    db = sqlite3.connect(db_path)
+    try:
+        samples = db.execute("""
+            SELECT COUNT(activity_windows.ts) FROM activity_samples
+            LEFT JOIN activity_windows USING (user_id, ts) GROUP BY activity_samples.ts ORDER BY activity_samples.ts
+        """).fetchall()
+    finally:
+        db.close()
+    # the windows it sent, then none once it disconnected
+    assert samples[-1] == (0,)
+
+
+def test_export_caps_samples(db):
+    record(db, T0, YOUTUBE)
+    record(db, T0 + 8 * HOUR, CODE)
+    record(db, T0 + 8 * HOUR + 30, [])
+
+    async def export():
+        async def batches():
+            yield main.query_activity_export(db, 1, T0, T0 + 9 * HOUR).fetchall()
+        return [sample async for samples in main.activity_export_samples(batches(), T0, T0 + 9 * HOUR) for sample in samples]
+
+    assert asyncio.run(export()) == [
+        (T0, main.SAMPLE_MAX_SECONDS, [('YouTube', 'MrBeast')]),
+        (T0 + 8 * HOUR, 30, [('Code', 'main.py')]),
+        (T0 + 8 * HOUR + 30, main.SAMPLE_MAX_SECONDS, []),
+    ]
@@ -0,0 +1,16 @@
+from fastapi.testclient import TestClient
+
+import main
+from app_client import App
+
+
+def test_export_rejects_empty_ranges(db_path):
+    with TestClient(main.app) as client:
+        with client.websocket_connect('/ws') as ws:
+            App(ws)
+        for start, end in [('2026-01-02T00:00:00', '2026-01-01T00:00:00'), ('2026-01-01T00:00:00', '2026-01-01T00:00:00')]:
+            resp = client.get('/export/activity', params={'machine_id': 'test-machine', 'start': start, 'end': end})
+            assert resp.status_code == 400
+        resp = client.get('/export/activity', params={
+            'machine_id': 'test-machine', 'start': '2026-01-01T00:00:00', 'end': '2026-01-02T00:00:00'})
+        assert resp.status_code == 200
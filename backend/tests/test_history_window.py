@@ -0,0 +1,46 @@
+"""
+The message window (MESSAGE_WINDOW) against what's rebuilt from the database: archiving older
+messages, then /clear starting the conversation over below the archived offset.
+
+    cd backend && python -m pytest tests
+"""
+from fastapi.testclient import TestClient
+
+import main
+from app_client import App, stored_state
+
+
+def test_window_rebuilds_from_database(db_path):
+    with TestClient(main.app) as client, client.websocket_connect('/ws') as ws:
+        app = App(ws)
+        app.receive()  # the greeting
+        for _ in range(20):
+            # answered with a debug message in place of the command
+            app.say('/activity')
+        assert app.state['historyOffset'] > 0
+        assert len(app.state['messages']) <= 10
+
+    # rebuilt from the latest snapshot's window, which the server trims when it sends the state
+    app_state, pinned = stored_state(db_path)
+    skip = app.state['historyOffset'] - app_state.history_offset
+    assert skip >= 0
+    assert [m.content for m in app_state.messages[skip:]] == [m['content'] for m in app.state['messages']]
+    assert [m.role for m in pinned] == ['system']
+
+
+def test_clear_after_archiving(db_path):
+    with TestClient(main.app) as client, client.websocket_connect('/ws') as ws:
+        app = App(ws)
+        app.receive()
+        for _ in range(20):
+            app.say('/activity')
+        assert app.state['historyOffset'] > 0
+
+        app.say('/clear')
+        assert app.state['historyOffset'] == 0
+        assert [m['role'] for m in app.state['messages']] == ['system', 'assistant']
+
+    app_state, pinned = stored_state(db_path)
+    assert app_state.history_offset == 0
+    assert [m.role for m in app_state.messages] == ['system', 'assistant']
+    assert pinned == []
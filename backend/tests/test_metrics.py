@@ -0,0 +1,21 @@
+import json
+
+from fastapi.testclient import TestClient
+
+import main
+import metrics
+from app_client import App
+
+
+def test_label_values_are_escaped():
+    assert metrics.format_labels(('a', 'b'), ('say "hi"\n', 'C:\\')) == '{a="say \\"hi\\"\\n",b="C:\\\\"}'
+
+
+def test_unknown_client_message_types_share_a_series(db_path):
+    with TestClient(main.app) as client, client.websocket_connect('/ws') as ws:
+        app = App(ws)
+        for i in range(3):
+            ws.send_text(json.dumps({'type': f'made up {i}'}))
+        app.say('/activity')
+    assert ('in', 'other') in main.WS_MESSAGE_CHARS.values
+    assert not [labels for labels in main.WS_MESSAGE_CHARS.values if labels[1].startswith('made up')]
@@ -0,0 +1,41 @@
+"""
+A client syncing its state before it applied everything the server sent, e.g. in the middle of a
+streamed reply: the server's messages are newer and must not be replaced by the client's.
+"""
+from fastapi.testclient import TestClient
+
+import main
+from app_client import App, stored_state
+
+REPLY = ['Hello there', ' this', ' is the full reply']
+
+
+async def stream_completion(body, priority=main.INTERACTIVE, deadline=None, key=None):
+    message = main.Message(role='assistant', content='')
+    for chunk in REPLY:
+        message.content += chunk
+        yield message
+
+
+def test_stale_sync_keeps_reply(db_path, monkeypatch):
+    monkeypatch.setattr(main, 'stream_completion', stream_completion)
+    with TestClient(main.app) as client, client.websocket_connect('/ws') as ws:
+        app = App(ws)
+        app.receive()  # the greeting
+
+        app.state['messages'].append({'role': 'user', 'content': 'hi'})
+        app.sync()
+        app.receive()  # the start of the reply
+        # typed while the rest of the reply is on its way
+        app.state['messages'].append({'role': 'user', 'content': '/activity'})
+        app.sync()
+
+        while True:
+            msg = app.receive()
+            if msg['type'] == 'state':
+                break
+        # the full reply, and what was typed after it
+        assert [m['content'] for m in app.state['messages']][-3:] == ['hi', ''.join(REPLY), '/activity']
+
+    app_state, _ = stored_state(db_path)
+    assert ''.join(REPLY) in [m.content for m in app_state.messages]
@@ -0,0 +1,42 @@
+from datetime import datetime
+
+import main
+
+START, END = datetime(2026, 1, 1, 9, 0), datetime(2026, 1, 1, 9, 10)
+
+
+def report(app_time, title_time, **limits):
+    return main.get_activity_summary_from_times(app_time, title_time, START, END, **limits)
+
+
+def test_same_apps_and_titles_hit():
+    cache = main.VerdictCache()
+    cache.add(report({'Code': 8, 'YouTube': 2}, {'Code': {'main.py': 8}, 'YouTube': {'MrBeast': 2}}))
+    assert cache.hit(report({'YouTube': 7, 'Code': 3}, {'Code': {'main.py': 3}, 'YouTube': {'MrBeast': 7}}))
+
+
+def test_subset_misses():
+    "Only YouTube isn't the mix of Code and YouTube that was judged on task"
+    cache = main.VerdictCache()
+    cache.add(report({'Code': 8, 'YouTube': 2}, {'Code': {'main.py': 8}, 'YouTube': {'MrBeast': 2}}))
+    assert not cache.hit(report({'YouTube': 10}, {'YouTube': {'MrBeast': 10}}))
+
+
+def test_reports_leaving_apps_out_are_not_cached():
+    cache = main.VerdictCache()
+    on_task = report({'Code': 8, 'Terminal': 2}, {}, max_lines=3)
+    assert 'other apps' in on_task
+    cache.add(on_task)
+    assert not cache.hit(on_task)
+    assert not cache.hit(report({'Code': 8, 'YouTube': 2}, {}, max_lines=3))
+
+
+def test_least_recently_used_is_evicted():
+    cache = main.VerdictCache(size=2)
+    reports = [report({app: 5}, {}) for app in ('Code', 'Terminal', 'Notes')]
+    cache.add(reports[0])
+    cache.add(reports[1])
+    assert cache.hit(reports[0])
+    cache.add(reports[2])
+    assert cache.hit(reports[0]) and cache.hit(reports[2])
+    assert not cache.hit(reports[1])